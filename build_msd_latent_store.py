@@ -0,0 +1,7 @@
+from multiprocessing import cpu_count
+
+from krotos.msd.latent import triplets
+
+
+
+triplets.build(workers=cpu_count())
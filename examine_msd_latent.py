@@ -51,14 +51,17 @@ with open(sid_mismatches_path, 'r') as sid_mismatches:
 
     report('')
 
-for sample in batch:
+# Neighbors of every sample in one pass over the song latent vectors.
+closest_ids, closest_idxs, closest_scores = lf.closest_batch(np.array([sample['latent_features'] for sample in batch]), n=200)
+song_norms = lf.song_norms()
+
+for i, sample in enumerate(batch):
     s           = sample['spectrogram_image']
-    features    = sample['latent_features']
     title       = sample['title']
     artist_name = sample['artist_name']
     f           = sample['tempfile']
 
-    closest = lf.closest(features, n=200, ordered=True)
+    closest = zip(closest_ids[i], closest_scores[i], song_norms[closest_idxs[i]])
 
     report('\t' + artist_name + ' - ' + title)
     report('\t' + '---')
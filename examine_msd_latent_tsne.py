@@ -60,7 +60,6 @@ norms           = np.linalg.norm(latents, axis=1)
 
 report("Retrieving song labels...")
 song_labels = {}
-echonest    = lf._echonest
 
 unique_tracks_path = os.path.join(ROOT_PATH, 'msd/resources/unique_tracks.txt')
 if not os.path.exists(unique_tracks_path): raise Exception("unique_tracks.txt not found.")
@@ -114,7 +113,7 @@ def onpick(event):
     ind = event.ind[0]
     idx = sample_idxs[ind]
     x, y = embedding[ind]
-    track_id_echonest = echonest.get_track_id(idx)
+    track_id_echonest = lf.song_id_map().get_ids([idx])[0]
     label = unicode(song_labels[track_id_echonest], errors='ignore')
 
     if last_ind == ind:
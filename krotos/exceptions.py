@@ -1,3 +1,7 @@
 class ParametersError(TypeError):
     def __init__(self, msg):
         super(ParametersError, self).__init__(msg)
+
+class WorkerError(RuntimeError):
+    def __init__(self, msg):
+        super(WorkerError, self).__init__(msg)
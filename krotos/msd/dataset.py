@@ -3,12 +3,20 @@ import os
 import pickle
 
 from krotos.paths import PATHS
+from krotos.utils import LRUCache
+from krotos.exceptions import ParametersError
 from krotos.msd.utils import msd_hdf5
+from krotos.msd.utils.tag_index import TagIndex
 from krotos.msd.processing import make_minibatch
 from krotos.debug import report
 
 
 
+# Training pools restricted to a tag filter, kept by filter.
+POOL_CACHE_SIZE = 8
+
+
+
 class Dataset(object):
     _initialized    = False
     _instance       = None
@@ -57,6 +65,8 @@ class Dataset(object):
         }, open(PATHS['msd_dataset_split'], 'wb'))
 
     def __init__(self, training_split, validation_split, testing_split, instance=None):
+        self._pools = LRUCache(POOL_CACHE_SIZE)
+
         if instance is not None:
             self._init_from_instance(instance)
             self._initialized = True
@@ -88,12 +98,23 @@ class Dataset(object):
         self._validation_inds   = shuffle[cut_1:cut_2]
         self._testing_inds      = shuffle[cut_2:]
 
-    def _sample_training_ind(self):
-        return np.random.choice(self._training_inds)
+    def _sample_training_ind(self, tag_filter=None):
+        return self._sample_training_inds(1, tag_filter)[0]
+
+    def _sample_training_inds(self, n, tag_filter=None):
+        # tag_filter: an optional TagIndex bitmap the samples must be in.
+        if tag_filter is None: return np.random.choice(self._training_inds, n)
+        return np.random.choice(self._training_pool(tag_filter), n)
+
+    def _training_pool(self, tag_filter):
+        # The training indices in a tag filter, selected once per filter.
+        pool = self._pools.get(np.asarray(tag_filter).tobytes(), lambda: TagIndex().select(self._training_inds, tag_filter))
+        if not len(pool): raise ParametersError("No training tracks match the tag filter.")
+        return pool
 
     # kwarg mapping may be one of the following:
     #   'both'
     #   'latent_features'
     #   'tag_vector'
-    def minibatch(self, n=10, mapping='both', trim=True, normalize=False, audio_tempfile=False):
-        return make_minibatch(self, n, mapping=mapping, trim=trim, normalize=normalize, audio_tempfile=audio_tempfile)
+    def minibatch(self, n=10, mapping='both', trim=True, normalize=False, audio_tempfile=False, tag_filter=None):
+        return make_minibatch(self, n, mapping=mapping, trim=trim, normalize=normalize, audio_tempfile=audio_tempfile, tag_filter=tag_filter)
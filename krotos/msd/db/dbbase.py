@@ -1,22 +1,80 @@
+import os
 import sqlite3
+import threading
+
+
+
+# Every thread (and every forked process) gets its own connection, opened
+# on first use, so DBConn subclasses can be queried from worker threads.
+# Those connections are query_only; statements that write, and the reads
+# that must see their uncommitted rows, go through a separate writable
+# connection per thread, opened only by subclasses that write.
+# Statements are parameterized, so sqlite3's per-connection statement cache
+# reuses them prepared.
+
+MMAP_SIZE           = 1 << 30
+
+# Negative sizes are in KiB.
+CACHE_SIZE          = -(1 << 16)
+
+CACHED_STATEMENTS   = 256
+
+# SQLite's default limit on variables in one statement.
+MAX_VARIABLES       = 999
+
+
+
+def placeholders(n):
+    # The variables of an IN list of n values.
+    return ', '.join(['?'] * n)
 
 
 
 class DBConn(object):
-    _conn           = None
+    _path           = None
+    _local          = None
 
     @classmethod
     def _initialize(cls):
         cls._establish_db_conn()
 
     @classmethod
-    def _execute(cls, query):
-        return cls._conn.execute(query)
+    def _connect(cls, writable=False):
+        conn = sqlite3.connect(cls._path, cached_statements=CACHED_STATEMENTS)
+        conn.execute("PRAGMA mmap_size = {};".format(MMAP_SIZE))
+        conn.execute("PRAGMA cache_size = {};".format(CACHE_SIZE))
+        if not writable: conn.execute("PRAGMA query_only = ON;")
+        return conn
+
+    @classmethod
+    def _connection(cls, writable=False):
+        # A process forked after connecting opens its own connections rather
+        # than sharing its parent's.
+        local = cls._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conns = {}
+            local.pid   = os.getpid()
+        if writable not in local.conns:
+            local.conns[writable] = cls._connect(writable)
+        return local.conns[writable]
+
+    @classmethod
+    def _execute(cls, query, params=(), writable=False):
+        return cls._connection(writable).execute(query, params)
+
+    @classmethod
+    def _executemany(cls, query, rows):
+        return cls._connection(writable=True).executemany(query, rows)
 
     @classmethod
     def _commit(cls):
-        cls._conn.commit()
+        cls._connection(writable=True).commit()
+
+    @classmethod
+    def _rollback(cls):
+        cls._connection(writable=True).rollback()
 
     @classmethod
     def _establish_db_conn(cls, path):
-        cls._conn = sqlite3.connect(path)
+        cls._path   = path
+        cls._local  = threading.local()
@@ -1,12 +1,17 @@
 import numpy as np
 
 from krotos.paths import PATHS
-from krotos.msd.db.dbbase import DBConn
+from krotos.msd.db.dbbase import DBConn, MAX_VARIABLES
 from krotos.msd.db.queries import echonest
 from krotos.debug import report
 
 
 
+PLAYCOUNT_BATCH_SIZE    = 100000
+TRIPLET_DTYPE           = [('user', np.int32), ('song', np.int32), ('count', np.float32)]
+
+
+
 def generator_result(cursor, size=1000):
     while True:
         batch = cursor.fetchmany(size)
@@ -14,6 +19,13 @@ def generator_result(cursor, size=1000):
             break
         yield batch
 
+def unique_ordered(ids):
+    seen = set()
+    for id_ in ids:
+        if id_ not in seen:
+            seen.add(id_)
+            yield id_
+
 class EchoNestTasteDB(DBConn):
     _initialized    = False
 
@@ -35,6 +47,11 @@ class EchoNestTasteDB(DBConn):
 
         return m, n
 
+    def get_last_play(self, writable=False):
+        # ROWID of the newest play. Plays are only ever appended, so this
+        # grows with every commit of add_playcounts.
+        return self._execute(echonest.last_play(subset=self.subset), writable=writable).fetchall()[0][0]
+
     def get_all_playcounts(self):
         # Remember that ROWIDs are 1-based indexes, not 0-based.
         # We will stick to the 0-based convention in this scope and expect
@@ -44,37 +61,116 @@ class EchoNestTasteDB(DBConn):
 
         data = self._execute(echonest.get_triplet(subset=self.subset))
 
-        result = np.ndarray(shape=(0,3))
+        # Fill preallocated, typed columns batch by batch rather than growing
+        # one array, which would copy everything fetched so far each time.
+        user        = np.empty(total, dtype=np.int32)
+        song        = np.empty(total, dtype=np.int32)
+        playcount   = np.empty(total, dtype=np.float32)
+        fetched     = 0
+
+        for batch in generator_result(data, size=PLAYCOUNT_BATCH_SIZE):
+            batch = np.array(batch, dtype=TRIPLET_DTYPE)
 
-        for batch in generator_result(data, size=10000):
-            result = np.append(result, batch, axis=0)
-            report("{:7.3f}% of rows fetched.".format(result.shape[0] * 100.0 / total), sameline=True)
+            if fetched + len(batch) > len(user):
+                capacity    = max(fetched + len(batch), 2 * len(user))
+                user        = np.resize(user, capacity)
+                song        = np.resize(song, capacity)
+                playcount   = np.resize(playcount, capacity)
+
+            user[fetched:(fetched + len(batch))]        = batch['user']
+            song[fetched:(fetched + len(batch))]        = batch['song']
+            playcount[fetched:(fetched + len(batch))]   = batch['count']
+            fetched += len(batch)
+
+            report("{:7.3f}% of rows fetched.".format(fetched * 100.0 / max(total, 1)), sameline=True)
 
         report('')
 
-        return result[:, 0], result[:, 1], result[:, 2]
+        return user[:fetched], song[:fetched], playcount[:fetched]
+
+    def get_user_ids(self):
+        # Every user id, by 0-based index.
+        return np.array([row[0] for row in self._execute(echonest.get_user_ids(subset=self.subset))], dtype='S40')
+
+    def get_song_ids(self):
+        # Every song id, by 0-based index.
+        return np.array([row[0] for row in self._execute(echonest.get_song_ids(subset=self.subset))], dtype='S18')
 
     def get_song_plays_by_user(self, u):
         # Remember that ROWIDs are 1-based indexes, not 0-based.
         # We will stick to the 0-based convention in this scope and expect
         # query function scopes to be 1-based.
 
-        data = self._execute(echonest.get_song_plays_by_user(subset=self.subset, user_rowid=(u + 1)))
+        data = self._execute(echonest.get_song_plays_by_user(subset=self.subset), (int(u) + 1,))
 
         song_col_idxs, counts = zip(*data.fetchall())
 
         return song_col_idxs, counts
 
+    # The track lookups below index songs by their SQLite ROWIDs. Stores
+    # built by triplets.build or subset.build index songs differently, so
+    # latent features are labelled through LatentFeatures.song_id_map.
     def get_track_idx(self, track_id_echonest):
-        result_set = self._execute(echonest.get_track_idx(subset=self.subset, track_id_echonest=track_id_echonest)).fetchall()
+        result_set = self._execute(echonest.get_track_idx(subset=self.subset), (track_id_echonest,)).fetchall()
         if not len(result_set): return None
         return result_set[0][0]
 
     def get_track_id(self, idx):
-        return self._execute(echonest.get_track_id(subset=self.subset, idx=(idx + 1))).fetchall()[0][0]
+        return self._execute(echonest.get_track_id(subset=self.subset), (int(idx) + 1,)).fetchall()[0][0]
 
     def get_track_ids(self, idxs):
-        data = self._execute(echonest.get_track_ids(subset=self.subset, idxs_string=(', '.join(str(idx + 1) for idx in idxs)))).fetchall()
-        track_ids_echonest, idxs = zip(*data)
-
-        return track_ids_echonest, idxs
+        # Echo Nest song ids of the known 0-based song indices among idxs,
+        # and those indices, in the order given.
+        found   = self._select_in(echonest.get_track_ids, [int(idx) + 1 for idx in idxs])
+        idxs    = tuple(int(idx) for idx in idxs if int(idx) in found)
+
+        return tuple(found[idx] for idx in idxs), idxs
+
+    def _select_in(self, query, keys, writable=False):
+        # The (key, value) rows an IN query over keys returns, as a dict,
+        # with a bounded number of variables per statement.
+        found = {}
+        for start_ind in xrange(0, len(keys), MAX_VARIABLES):
+            chunk = list(keys[start_ind:(start_ind + MAX_VARIABLES)])
+            found.update(self._execute(query(subset=self.subset, n=len(chunk)), chunk, writable=writable).fetchall())
+        return found
+
+    def _get_idxs(self, query, ids, writable=False):
+        found = self._select_in(query, ids, writable)
+        return np.array([found.get(id_, -1) for id_ in ids], dtype=np.int64)
+
+    def get_user_idxs(self, user_ids, writable=False):
+        # 0-based indices of each user id, or -1 if it is unknown. Ids added
+        # but not yet committed are only seen with writable=True.
+        return self._get_idxs(echonest.get_user_idxs, user_ids, writable)
+
+    def get_song_idxs(self, song_ids, writable=False):
+        # 0-based indices of each song id, or -1 if it is unknown. Ids added
+        # but not yet committed are only seen with writable=True.
+        return self._get_idxs(echonest.get_song_idxs, song_ids, writable)
+
+    def add_playcounts(self, user_ids, song_ids, counts, commit=True):
+        # Records new plays, giving unseen users and songs the next free
+        # indices, and returns the indices of each triplet's user and song.
+        # Plays are appended, so repeated (user, song) pairs add up.
+        # Unseen ids are inserted in order of first appearance.
+        #
+        # Writes go through this thread's writable connection; the pooled
+        # connections stay query_only. With commit=False the plays are only
+        # visible to that connection until commit() is called, and
+        # rollback() discards them.
+        self._executemany(echonest.insert_user(subset=self.subset), ((user_id,) for user_id in unique_ordered(user_ids)))
+        self._executemany(echonest.insert_song(subset=self.subset), ((song_id,) for song_id in unique_ordered(song_ids)))
+        self._executemany(echonest.insert_play(subset=self.subset), zip(user_ids, song_ids, (int(count) for count in counts)))
+        if commit: self._commit()
+
+        users, user_inverse = np.unique(user_ids, return_inverse=True)
+        songs, song_inverse = np.unique(song_ids, return_inverse=True)
+
+        return self.get_user_idxs(users, writable=True)[user_inverse], self.get_song_idxs(songs, writable=True)[song_inverse]
+
+    def commit(self):
+        self._commit()
+
+    def rollback(self):
+        self._rollback()
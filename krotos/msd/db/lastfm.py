@@ -36,7 +36,7 @@ class LastFMTagsDB(DBConn):
                 cls._tag_subset = pickle.load(f)
             return
 
-        res = cls._execute(lastfm.most_popular_tags(n=N_TAGS))
+        res = cls._execute(lastfm.most_popular_tags(), (N_TAGS,))
         cls._tag_subset = sorted(res.fetchall(), key=lambda row: row[0])
 
         with open(PATHS['tag_subset'], 'w') as f:
@@ -56,11 +56,22 @@ class LastFMTagsDB(DBConn):
         )
 
     def get_tag_ids(self, track_id):
-        res = self._execute(lastfm.all_tags(track_id=track_id))
+        res = self._execute(lastfm.all_tags(), (track_id,))
         data = res.fetchall()
 
         return np.intersect1d([row[0] for row in data], self._tag_subset_ids)
 
+    def get_tids(self):
+        # Every MSD track id, by 0-based tids ROWID.
+        return np.array([row[0] for row in self._execute(lastfm.all_tids())], dtype='S18')
+
+    def get_subset_taggings(self):
+        # 0-based tids ROWID and tag id of every tagging with a subset tag.
+        res     = self._execute(lastfm.tid_tags_in(n=len(self._tag_subset_ids)), [int(tag_id) for tag_id in self._tag_subset_ids])
+        data    = np.array(res.fetchall(), dtype=np.int64).reshape(-1, 2)
+
+        return data[:, 0] - 1, data[:, 1]
+
     def get_tag_names(self, tag_vector):
         if tag_vector is None: return []
         return [row[1] for i, row in zip(xrange(N_TAGS), self._tag_subset) if tag_vector[i] > 0.0]
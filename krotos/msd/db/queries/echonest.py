@@ -1,3 +1,7 @@
+from krotos.msd.db.dbbase import placeholders
+
+
+
 def decorate_kwargs(kwargs):
     d = kwargs.copy()
     d.update({
@@ -19,6 +23,10 @@ def triplet_count(*args, **kwargs):
     return """SELECT count(*)
         FROM    {plays};""".format(**decorate_kwargs(kwargs))
 
+def last_play(*args, **kwargs):
+    return """SELECT coalesce(max(ROWID), 0)
+        FROM    {plays};""".format(**decorate_kwargs(kwargs))
+
 def get_triplet(*args, **kwargs):
     return """SELECT {vector_users}.ROWID - 1, {vector_songs}.ROWID - 1, {plays}.count
         FROM    {vector_users}, {vector_songs}, {plays}
@@ -28,21 +36,53 @@ def get_triplet(*args, **kwargs):
 def get_song_plays_by_user(*args, **kwargs):
     return """SELECT {vector_songs}.ROWID - 1, {plays}.count
         FROM    {vector_users}, {vector_songs}, {plays}
-        WHERE   {vector_users}.ROWID = {user_rowid}
+        WHERE   {vector_users}.ROWID = ?
         AND     {vector_users}.user = {plays}.user
         AND     {vector_songs}.song = {plays}.song;""".format(**decorate_kwargs(kwargs))
 
 def get_track_idx(*args, **kwargs):
     return """SELECT {vector_songs}.ROWID - 1
         FROM    {vector_songs}
-        WHERE   {vector_songs}.song = '{track_id_echonest}';""".format(**decorate_kwargs(kwargs))
+        WHERE   {vector_songs}.song = ?;""".format(**decorate_kwargs(kwargs))
 
 def get_track_id(*args, **kwargs):
     return """SELECT {vector_songs}.song
         FROM    {vector_songs}
-        WHERE   {vector_songs}.rowid = {idx};""".format(**decorate_kwargs(kwargs))
+        WHERE   {vector_songs}.rowid = ?;""".format(**decorate_kwargs(kwargs))
 
 def get_track_ids(*args, **kwargs):
+    return """SELECT {vector_songs}.ROWID - 1, {vector_songs}.song
+        FROM    {vector_songs}
+        WHERE   {vector_songs}.ROWID IN ({placeholders});""".format(placeholders=placeholders(kwargs['n']), **decorate_kwargs(kwargs))
+
+def get_user_idxs(*args, **kwargs):
+    return """SELECT {vector_users}.user, {vector_users}.ROWID - 1
+        FROM    {vector_users}
+        WHERE   {vector_users}.user IN ({placeholders});""".format(placeholders=placeholders(kwargs['n']), **decorate_kwargs(kwargs))
+
+def get_song_idxs(*args, **kwargs):
     return """SELECT {vector_songs}.song, {vector_songs}.ROWID - 1
         FROM    {vector_songs}
-        WHERE   {vector_songs}.ROWID IN ({idxs_string});""".format(**decorate_kwargs(kwargs))
+        WHERE   {vector_songs}.song IN ({placeholders});""".format(placeholders=placeholders(kwargs['n']), **decorate_kwargs(kwargs))
+
+def insert_user(*args, **kwargs):
+    return """INSERT OR IGNORE INTO {vector_users} (user)
+        VALUES  (?);""".format(**decorate_kwargs(kwargs))
+
+def insert_song(*args, **kwargs):
+    return """INSERT OR IGNORE INTO {vector_songs} (song)
+        VALUES  (?);""".format(**decorate_kwargs(kwargs))
+
+def insert_play(*args, **kwargs):
+    return """INSERT INTO {plays} (user, song, count)
+        VALUES  (?, ?, ?);""".format(**decorate_kwargs(kwargs))
+
+def get_user_ids(*args, **kwargs):
+    return """SELECT {vector_users}.user
+        FROM    {vector_users}
+        ORDER BY {vector_users}.ROWID;""".format(**decorate_kwargs(kwargs))
+
+def get_song_ids(*args, **kwargs):
+    return """SELECT {vector_songs}.song
+        FROM    {vector_songs}
+        ORDER BY {vector_songs}.ROWID;""".format(**decorate_kwargs(kwargs))
@@ -1,3 +1,7 @@
+from krotos.msd.db.dbbase import placeholders
+
+
+
 def most_popular_tags(*args, **kwargs):
     return """SELECT tags.ROWID, tags.tag, count(tid_tag.tag)
         FROM        tid_tag
@@ -5,10 +9,20 @@ def most_popular_tags(*args, **kwargs):
         ON          tid_tag.tag = tags.ROWID
         GROUP BY    tags.tag
         ORDER BY    count(tid_tag.tag) DESC
-        LIMIT       {n};""".format(**kwargs)
+        LIMIT       ?;"""
 
 def all_tags(*args, **kwargs):
     return """SELECT tid_tag.tag
         FROM    tid_tag, tids
-        WHERE   tids.tid = '{track_id}'
-        AND     tids.ROWID = tid_tag.tid;""".format(**kwargs)
+        WHERE   tids.tid = ?
+        AND     tids.ROWID = tid_tag.tid;"""
+
+def all_tids(*args, **kwargs):
+    return """SELECT tids.tid
+        FROM    tids
+        ORDER BY tids.ROWID;"""
+
+def tid_tags_in(*args, **kwargs):
+    return """SELECT tid_tag.tid, tid_tag.tag
+        FROM    tid_tag
+        WHERE   tid_tag.tag IN ({placeholders});""".format(placeholders=placeholders(kwargs['n']))
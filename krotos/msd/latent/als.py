@@ -1,6 +1,192 @@
 import numpy as np
+from scipy import sparse
 
-def confidence_transform(R, param_alpha, param_epsilon):
-    C = R.copy()
-    C.data = param_alpha * np.log(1 + param_epsilon * C.data)
-    return C
+
+
+# Upper bound on the bytes of gathered rows of B held at once by a solver,
+# one f-vector per confidence entry; see block_nnz.
+BLOCK_BYTES = 1 << 26
+
+# Upper bound on the bytes of gathered rows of X and Y held at once when
+# evaluating the objective; see objective_nnz.
+OBJECTIVE_BYTES = 1 << 26
+
+# Conjugate gradient steps taken per row by the 'cg' solver.
+CG_STEPS = 3
+
+def confidence_transform(R, param_alpha, param_epsilon, copy=True):
+    # With copy=False, R's entries are overwritten by their confidences
+    # rather than copied, once they are floating point.
+    if copy:
+        C = R.copy()
+        C.data = param_alpha * np.log(1 + param_epsilon * C.data)
+        return C
+
+    if R.data.dtype.kind != 'f': R.data = R.data.astype(np.float64)
+
+    np.multiply(R.data, param_epsilon, out=R.data)
+    np.log1p(R.data, out=R.data)
+    np.multiply(R.data, param_alpha, out=R.data)
+    return R
+
+def confidence(counts, param_alpha, param_epsilon):
+    # confidence_transform of an array of play counts.
+    return param_alpha * np.log1p(param_epsilon * np.asarray(counts, dtype=np.float64))
+
+def confidence_inverse(conf, param_alpha, param_epsilon):
+    # Recovers the play counts that confidence mapped to an array of
+    # confidences.
+    return np.expm1(np.asarray(conf, dtype=np.float64) / param_alpha) / param_epsilon
+
+def objective(X, Y, C_ui, param_lambda, max_nnz=None):
+    # The weighted implicit feedback loss of Hu et al. (2008),
+    #
+    #   sum_ui c_ui (p_ui - x_u^T y_i)^2 + lambda (|X|^2 + |Y|^2)
+    #
+    # where c_ui = 1, p_ui = 0 outside the confidence entries. Over all pairs,
+    # sum_ui (x_u^T y_i)^2 = tr(X^T X Y^T Y); each confidence entry replaces
+    # its share of that with c_ui (1 - x_u^T y_i)^2 (see objective_entries).
+    # Only the confidence entries are scored, never the dense m-by-n product.
+    return combine_objective(X.T.dot(X), Y.T.dot(Y), objective_entries(X, Y, C_ui, max_nnz), param_lambda)
+
+def objective_entries(A, B, C_ab, max_nnz=None):
+    # The confidence entries' share of the objective, sum c_ab (1 - p_ab)^2 -
+    # p_ab^2 with p_ab = a^T b, for the rows of A that C_ab covers; the same
+    # whether scored by user (X, Y, C_ui) or by song (Y, X, C_iu). Entries are
+    # scored max_nnz at a time (by default as many as fit in
+    # OBJECTIVE_BYTES), regardless of row boundaries.
+    max_nnz = max_nnz or objective_nnz(A.shape[1])
+    loss    = 0.0
+
+    for lo in xrange(0, C_ab.indptr[-1], max_nnz):
+        hi      = min(lo + max_nnz, C_ab.indptr[-1])
+        rows    = np.searchsorted(C_ab.indptr, np.arange(lo, hi), side='right') - 1
+        conf    = C_ab.data[lo:hi]
+
+        predicted   = np.einsum('ij,ij->i', A[rows], B[C_ab.indices[lo:hi]])
+        loss       += np.sum(conf * (1 - predicted) ** 2 - predicted ** 2)
+
+    return loss
+
+def combine_objective(X_T_X, Y_T_Y, entries, param_lambda):
+    # The objective from the Gram matrices of X and Y and objective_entries
+    # summed over all confidence entries; |X|^2 = tr(X^T X).
+    return np.sum(X_T_X * Y_T_Y) + entries + param_lambda * (np.trace(X_T_X) + np.trace(Y_T_Y))
+
+def regularized_gram(B, param_lambda):
+    return B.T.dot(B) + (param_lambda * np.eye(B.shape[1]))
+
+def update(A, B, C_ab, param_lambda, solver='block'):
+    # Solves every row of A in place against the fixed B; one half-step of
+    # minimization, without checkpoints.
+    solve_rows(A, B, C_ab, regularized_gram(B, param_lambda), 0, A.shape[0], solver)
+
+def solve_rows(A, B, C_ab, B_T_B_regularized, start_ind, end_ind, solver='block', progress=None):
+    # Solves rows [start_ind, end_ind) of A in place against the fixed B, one
+    # memory-bounded block at a time. progress, if given, is called with the
+    # end of each block once it is written.
+    solve = SOLVERS[solver]
+
+    for block_start, block_end in row_blocks(C_ab.indptr, start_ind, end_ind, block_nnz(B.shape[1])):
+        A[block_start:block_end] = solve(A, B, C_ab, B_T_B_regularized, block_start, block_end)
+
+        if progress is not None: progress(block_end)
+
+def block_nnz(f):
+    # Confidence entries per block, each gathering one float64 row of B, so
+    # that a block stays within BLOCK_BYTES whatever the rank.
+    return max(1, BLOCK_BYTES // (f * 8))
+
+def objective_nnz(f):
+    # Confidence entries scored at once, each gathering one float64 row of X
+    # and one of Y, so that a chunk stays within OBJECTIVE_BYTES whatever the
+    # rank.
+    return max(1, OBJECTIVE_BYTES // (2 * f * 8))
+
+def row_blocks(indptr, start_ind, end_ind, max_nnz):
+    # Split rows [start_ind, end_ind) into contiguous blocks holding at most
+    # max_nnz confidence entries. A row with more entries than that is given
+    # a block of its own.
+    lo = start_ind
+    while lo < end_ind:
+        hi = np.searchsorted(indptr, indptr[lo] + max_nnz, side='right') - 1
+        hi = min(max(hi, lo + 1), end_ind)
+        yield lo, hi
+        lo = hi
+
+def solve_block(A, B, C_ab, B_T_B_regularized, start_ind, end_ind):
+    # Solves the normal equations of rows [start_ind, end_ind) of A at once,
+    #
+    #   (B^T C_a B + lambda I) a = B^T C_a p(a)
+    #
+    # using B^T C_a B = B^T B + B^T (C_a - I) B, where only the rows of B
+    # referenced by each row's confidence entries contribute to the second
+    # term. Each row's system is formed with one GEMM over its gathered rows
+    # of B and solved on its own. Returns the solved rows rather than
+    # writing them into A.
+    lo, hi  = C_ab.indptr[start_ind], C_ab.indptr[end_ind]
+    indptr  = C_ab.indptr[start_ind:(end_ind + 1)] - lo
+    conf    = C_ab.data[lo:hi]
+
+    B_gathered  = B[C_ab.indices[lo:hi]]
+    B_weighted  = B_gathered * (conf - 1)[:, np.newaxis]
+
+    solved = np.empty((end_ind - start_ind, B.shape[1]), dtype=np.result_type(B_weighted, B_T_B_regularized))
+    for row in xrange(end_ind - start_ind):
+        entries     = slice(indptr[row], indptr[row + 1])
+        left        = B_weighted[entries].T.dot(B_gathered[entries]) + B_T_B_regularized
+        solved[row] = np.linalg.solve(left, conf[entries].dot(B_gathered[entries]))
+
+    return solved
+
+def solve_cg(A, B, C_ab, B_T_B_regularized, start_ind, end_ind, steps=None):
+    # Approximately solves the same normal equations as solve_block with a
+    # fixed number of conjugate gradient steps per row, warm-started from the
+    # rows' current values in A (Takacs et al., 2011). Products against
+    # B^T C_a B + lambda I are taken as B_T_B_regularized x plus the sparse
+    # correction B^T (C_a - I) (B x), so no per-row f-by-f matrix is formed.
+    # All rows of the block are iterated together.
+    rows    = end_ind - start_ind
+
+    lo, hi  = C_ab.indptr[start_ind], C_ab.indptr[end_ind]
+    indptr  = C_ab.indptr[start_ind:(end_ind + 1)] - lo
+    cols    = C_ab.indices[lo:hi]
+    conf    = C_ab.data[lo:hi]
+
+    B_gathered  = B[cols]
+    positions   = np.arange(hi - lo)
+    entry_rows  = np.repeat(np.arange(rows), np.diff(indptr))
+
+    weights = sparse.csr_matrix((conf - 1, positions, indptr), shape=(rows, hi - lo))
+
+    def product(v):
+        projected = np.einsum('ij,ij->i', B_gathered, v[entry_rows])
+        return v.dot(B_T_B_regularized) + weights.dot(B_gathered * projected[:, np.newaxis])
+
+    x = np.array(A[start_ind:end_ind], dtype=B_T_B_regularized.dtype)
+
+    r   = sparse.csr_matrix((conf, positions, indptr), shape=(rows, hi - lo)).dot(B_gathered) - product(x)
+    p   = r.copy()
+    rs  = np.einsum('ij,ij->i', r, r)
+
+    for _ in xrange(steps or CG_STEPS):
+        Ap      = product(p)
+        pAp     = np.einsum('ij,ij->i', p, Ap)
+        alpha   = np.where(pAp > 0, rs / np.where(pAp > 0, pAp, 1), 0)
+
+        x      += alpha[:, np.newaxis] * p
+        r      -= alpha[:, np.newaxis] * Ap
+
+        rs_next = np.einsum('ij,ij->i', r, r)
+        beta    = np.where(rs > 0, rs_next / np.where(rs > 0, rs, 1), 0)
+        p       = r + beta[:, np.newaxis] * p
+        rs      = rs_next
+
+    return x
+
+
+
+SOLVERS = {
+    'block':    solve_block,
+    'cg':       solve_cg,
+}
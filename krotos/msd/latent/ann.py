@@ -0,0 +1,156 @@
+import time
+import numpy as np
+from scipy import sparse
+
+from krotos.utils import atomic_write
+from krotos.msd.latent import ranking
+from krotos.debug import report
+
+
+
+# An inverted-file (IVF) index over the song latent vectors for approximate
+# cosine similarity search. Normalized vectors are clustered with spherical
+# k-means; a query scores the centroids, scans only the `nprobe` closest
+# lists with float32 vectors, and reranks the best `rerank * k` of those
+# against the exact vectors. nprobe trades recall for latency.
+
+NPROBE          = 8
+RERANK          = 4
+KMEANS_ITER     = 10
+TRAIN_PER_LIST  = 64
+
+
+
+def _normalize(A):
+    norms = np.linalg.norm(A, axis=1)
+    return A / np.where(norms > 0, norms, 1)[:, np.newaxis], norms
+
+def _fingerprint(Y):
+    # Cheap check that an index still describes Y.
+    return np.array([Y.shape[0], Y.shape[1], np.sum(Y[::max(1, Y.shape[0] // 1000)])], dtype=np.float64)
+
+def _assign(vectors, centroids):
+    assignment = np.empty(vectors.shape[0], dtype=np.int64)
+    chunk_size = ranking.chunk_rows(centroids.shape[0])
+
+    for start_ind in xrange(0, vectors.shape[0], chunk_size):
+        end_ind = min(start_ind + chunk_size, vectors.shape[0])
+        assignment[start_ind:end_ind] = np.argmax(vectors[start_ind:end_ind].dot(centroids.T), axis=1)
+
+    return assignment
+
+def _spherical_kmeans(vectors, n_lists, iterations, random):
+    centroids = vectors[random.choice(vectors.shape[0], n_lists, replace=False)].copy()
+
+    for _ in xrange(iterations):
+        assignment  = _assign(vectors, centroids)
+        members     = sparse.csr_matrix(
+            (np.ones(len(assignment)), (assignment, np.arange(len(assignment)))),
+            shape=(n_lists, vectors.shape[0])
+        )
+        sums        = members.dot(vectors)
+
+        # Lists that lost all their vectors restart from random ones.
+        empty           = np.flatnonzero(np.bincount(assignment, minlength=n_lists) == 0)
+        sums[empty]     = vectors[random.choice(vectors.shape[0], len(empty), replace=False)]
+        centroids, _    = _normalize(sums)
+
+    return centroids
+
+
+
+class IVFIndex(object):
+    def __init__(self, Y, centroids, vectors, ids, offsets, fingerprint):
+        self.Y              = Y
+        self.centroids      = centroids
+        self.vectors        = vectors
+        self.ids            = ids
+        self.offsets        = offsets
+        self.fingerprint    = fingerprint
+
+    @classmethod
+    def build(cls, Y, n_lists=None, iterations=KMEANS_ITER, seed=0):
+        n           = Y.shape[0]
+        n_lists     = min(n, n_lists or max(1, int(2 * np.sqrt(n))))
+        random      = np.random.RandomState(seed)
+
+        normalized, _       = _normalize(np.asarray(Y, dtype=np.float32))
+        sample              = normalized[random.choice(n, min(n, n_lists * TRAIN_PER_LIST), replace=False)]
+
+        report("Clustering {} song vectors into {} lists...".format(n, n_lists))
+        centroids   = _spherical_kmeans(sample, n_lists, iterations, random)
+        assignment  = _assign(normalized, centroids)
+
+        # Store each list's vectors contiguously.
+        ids     = np.argsort(assignment, kind='mergesort')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=n_lists))))
+
+        return cls(Y, centroids, normalized[ids], ids, offsets, _fingerprint(Y))
+
+    @classmethod
+    def load(cls, path, Y):
+        # None if there is no index at path or it was built from another Y.
+        try:
+            obj = np.load(path)
+        except IOError:
+            return None
+
+        if not np.array_equal(obj['fingerprint'], _fingerprint(Y)): return None
+
+        return cls(Y, obj['centroids'], obj['vectors'], obj['ids'], obj['offsets'], obj['fingerprint'])
+
+    def save(self, path):
+        with atomic_write(path) as tmp_path, open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                centroids=self.centroids,
+                vectors=self.vectors,
+                ids=self.ids,
+                offsets=self.offsets,
+                fingerprint=self.fingerprint
+            )
+
+    def query(self, features, k=5, nprobe=NPROBE, rerank=RERANK, mask=None):
+        # Indices into Y of about the k most cosine-similar songs, and their
+        # exact similarities, best first, optionally only among the songs set
+        # in mask, a boolean array over Y's rows.
+        q = np.asarray(features, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1)
+
+        lists       = np.argsort(-self.centroids.dot(q))[:nprobe]
+        positions   = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+        if mask is not None: positions = positions[mask[self.ids[positions]]]
+
+        approximate = self.vectors[positions].dot(q)
+        keep        = min(len(positions), rerank * k)
+        if keep == 0: return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        candidates  = self.ids[positions[np.argpartition(-approximate, keep - 1)[:keep]]]
+
+        # Reranked against the rows of Y in float64, so that similarities
+        # match a brute force search.
+        rows        = np.asarray(self.Y[candidates], dtype=np.float64)
+        norms       = np.linalg.norm(rows, axis=1)
+        exact       = rows.dot(np.asarray(features, dtype=np.float64))
+        exact      /= np.where(norms > 0, norms, 1) * (np.linalg.norm(features) or 1)
+
+        order = np.argsort(-exact)[:k]
+        return candidates[order], exact[order]
+
+    def recall(self, queries, k=10, nprobe=NPROBE, rerank=RERANK):
+        # Mean fraction of the exact top k found by query() for each row of
+        # queries, and the mean query time in seconds.
+        normalized, _   = _normalize(np.asarray(self.Y, dtype=np.float64))
+        found           = 0
+        elapsed         = 0.0
+
+        for features in queries:
+            exact = np.argpartition(-normalized.dot(features), k - 1)[:k]
+
+            start           = time.time()
+            approximate, _  = self.query(features, k, nprobe, rerank)
+            elapsed        += time.time() - start
+
+            found += len(np.intersect1d(exact, approximate))
+
+        return found / float(k * len(queries)), elapsed / len(queries)
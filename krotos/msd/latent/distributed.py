@@ -0,0 +1,351 @@
+import os
+import threading
+import traceback
+import numpy as np
+from scipy import sparse
+from multiprocessing import Process, AuthenticationError
+from multiprocessing.connection import Listener, Client, answer_challenge, deliver_challenge
+
+from krotos.utils import atomic_write
+from krotos.msd.latent import als, parallel
+from krotos.exceptions import ParametersError, WorkerError
+from krotos.debug import report
+
+
+
+# Workers on other machines join a coordinator by running
+#
+#   serve((host, port), authkey)
+#
+# with the address the coordinator listens on and the authkey it was given.
+# Connections unpickle whatever they receive, so the key must be a secret
+# shared only with the workers. Locally spawned workers are handed a random
+# key generated for each coordinator. Workers read their confidence rows from
+# the files write_shards puts in the store, so remote workers need the store
+# directory mounted at the same path.
+AUTHKEY_BYTES = 32
+
+# Seconds to wait for every worker to connect before giving up.
+ACCEPT_TIMEOUT = 300
+
+# Times a half-step is retried with a fresh set of workers after one dies.
+# Errors raised inside a worker are not retried.
+RETRIES = 3
+
+
+
+def _solve_shard(A_block, B, C_block, B_T_B_regularized, solver):
+    als.solve_rows(A_block, B, C_block, B_T_B_regularized, 0, A_block.shape[0], solver)
+    return A_block
+
+def _load_shard(path):
+    with open(path, 'rb') as f:
+        obj = np.load(f)
+        return sparse.csr_matrix((obj['data'], obj['indices'], obj['indptr']), shape=obj['shape'])
+
+def serve(address, authkey):
+    # Worker loop. A worker owns one row shard of X and of Y, and loads the
+    # matching rows of C_ui and C_iu from their shard files, re-indexed into
+    # the rows of the other matrix the shard references. Before each
+    # half-step it is sent those rows of the fixed matrix piece by piece, as
+    # the workers owning them hand them over; it then solves its shard and
+    # sends back the updated block, the block's share of the next Gram
+    # matrix and its confidence entries' share of the objective. Failures
+    # are sent back as ('error', traceback) before the worker exits.
+    conn    = Client(address, authkey=authkey)
+    shard   = None
+
+    try:
+        while True:
+            message = conn.recv()
+
+            if message[0] == 'setup':
+                _, blocks, paths = message
+                shard = dict(blocks)
+                for mtx, path in paths.items():
+                    shard['C_' + mtx] = _load_shard(path)
+            elif message[0] == 'rows':
+                _, mtx, idxs = message
+                conn.send(('rows', shard[mtx][idxs]))
+            elif message[0] == 'gram':
+                _, mtx = message
+                conn.send(('gram', shard[mtx].T.dot(shard[mtx])))
+            elif message[0] == 'fixed':
+                _, rows, f, dtype = message
+                shard['B'] = np.empty((rows, f), dtype=dtype)
+            elif message[0] == 'piece':
+                _, start_ind, rows = message
+                shard['B'][start_ind:(start_ind + len(rows))] = rows
+            elif message[0] == 'solve':
+                _, mtx, B_T_B_regularized, solver = message
+                B, C_block  = shard.pop('B'), shard['C_' + mtx]
+                A_block     = _solve_shard(shard[mtx], B, C_block, B_T_B_regularized, solver)
+                conn.send(('solved', A_block, A_block.T.dot(A_block), als.objective_entries(A_block, B, C_block)))
+            elif message[0] == 'stop':
+                break
+    except EOFError:
+        pass
+    except Exception:
+        try:
+            conn.send(('error', traceback.format_exc()))
+        except (IOError, EOFError):
+            pass
+    finally:
+        conn.close()
+
+def _columns(C, lo, hi):
+    # The sorted columns referenced by rows [lo, hi) of a CSR matrix.
+    return np.unique(C.indices[C.indptr[lo]:C.indptr[hi]])
+
+def _localize(C, lo, hi, columns):
+    # Rows [lo, hi) of a CSR matrix, re-indexed into its referenced columns.
+    C_block = C[lo:hi]
+    return sparse.csr_matrix(
+        (C_block.data, np.searchsorted(columns, C_block.indices).astype(np.int32), C_block.indptr),
+        shape=(hi - lo, len(columns))
+    )
+
+def _shard(indptr, rows, workers):
+    # One row range per worker; empty ranges pad out tiny matrices.
+    shards = parallel.shard_rows(indptr, 0, rows, workers)
+    return shards + [(rows, rows)] * (workers - len(shards))
+
+def write_shards(C_ui, C_iu, workers, directory):
+    # Splits X and Y into one row shard per worker, balanced by confidence
+    # entries, and writes each shard's rows of C_ui and C_iu to directory for
+    # the worker to load. Returns the layout a Coordinator runs over: the row
+    # ranges, the rows of the other matrix each shard references, and the
+    # shard files, by the matrix being solved.
+    if not os.path.isdir(directory): os.makedirs(directory)
+
+    layout = {'shards': {}, 'columns': {}, 'paths': {}}
+
+    for mtx, C in (('X', C_ui), ('Y', C_iu)):
+        shards  = _shard(C.indptr, C.shape[0], workers)
+        columns = [_columns(C, lo, hi) for lo, hi in shards]
+        paths   = [os.path.join(directory, '{}_{:03d}.npz'.format(mtx, ind)) for ind in xrange(workers)]
+
+        for (lo, hi), shard_columns, path in zip(shards, columns, paths):
+            C_block = _localize(C, lo, hi, shard_columns)
+            with atomic_write(path) as tmp_path, open(tmp_path, 'wb') as f:
+                np.savez(f, data=C_block.data, indices=C_block.indices, indptr=C_block.indptr, shape=C_block.shape)
+
+        layout['shards'][mtx]   = shards
+        layout['columns'][mtx]  = columns
+        layout['paths'][mtx]    = paths
+
+    return layout
+
+
+
+class Coordinator(object):
+    # Runs half-steps of ALS over a set of socket-connected workers, each
+    # holding a row shard of X and Y and its rows of C_ui and C_iu (see
+    # write_shards) for as long as they live. The coordinator holds no
+    # confidences: per half-step it moves the rows of the fixed matrix each
+    # worker references over from the workers that own them, one piece at a
+    # time, and sums the f-by-f partial Gram matrices and objective terms the
+    # workers send back. Solved blocks are written into X and Y as they
+    # arrive, for checkpointing; workers are only (re)started from them.
+    #
+    # With spawn=True the workers are forked locally; otherwise as many
+    # remote processes as the layout has shards are expected to connect with
+    # serve(), given the same authkey.
+
+    def __init__(self, X, Y, layout, param_lambda, solver='block', address=('localhost', 0), spawn=True, authkey=None, accept_timeout=ACCEPT_TIMEOUT):
+        if authkey is None:
+            if not spawn: raise ParametersError("Remote ALS workers need an authkey shared with them.")
+            authkey = os.urandom(AUTHKEY_BYTES)
+
+        self.X, self.Y      = X, Y
+        self.param_lambda   = param_lambda
+        self.workers        = len(layout['paths']['X'])
+        self.solver         = solver
+        self.spawn          = spawn
+        self.accept_timeout = accept_timeout
+
+        self._shards        = layout['shards']
+        self._columns       = layout['columns']
+        self._paths         = layout['paths']
+
+        # Connections are authenticated in _accept, so that those failing it
+        # can be closed.
+        self._authkey       = authkey
+        self._listener      = Listener(address)
+        self.address        = self._listener.address
+
+        self._processes     = []
+        self._conns         = []
+        self._grams         = {}
+        self._entries       = None
+
+        try:
+            self._start()
+        except:
+            self.close()
+            raise
+
+    def _authenticate(self, conn):
+        try:
+            deliver_challenge(conn, self._authkey)
+            answer_challenge(conn, self._authkey)
+        except (AuthenticationError, IOError, EOFError):
+            conn.close()
+            report("Rejected a connection that failed authentication.")
+            return False
+        return True
+
+    def _accept(self):
+        # Listener.accept() cannot time out, so workers are accepted on a
+        # daemon thread while this one waits for them, giving up after
+        # accept_timeout seconds or as soon as a spawned worker has died.
+        conns   = []
+        errors  = []
+
+        def accept():
+            try:
+                while len(conns) < self.workers:
+                    conn = self._listener.accept()
+                    if self._authenticate(conn): conns.append(conn)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=accept)
+        thread.daemon = True
+        thread.start()
+
+        for _ in xrange(max(1, int(self.accept_timeout))):
+            thread.join(1)
+            if not thread.is_alive(): break
+            if any(process.exitcode is not None for process in self._processes): break
+
+        if len(conns) < self.workers:
+            for conn in conns:
+                conn.close()
+            if errors: raise errors[0]
+            raise IOError("Only {} of {} ALS workers connected to {}:{}.".format(len(conns), self.workers, *self.address))
+
+        return conns
+
+    def _start(self):
+        if self.spawn:
+            for _ in xrange(self.workers):
+                process = Process(target=serve, args=(self.address, self._authkey))
+                process.daemon = True
+                process.start()
+                self._processes.append(process)
+
+        report("Waiting for {} ALS workers on {}:{}.".format(self.workers, *self.address))
+        self._conns = self._accept()
+
+        # Shards are (re)sent from the coordinator's copy of X and Y, which
+        # only ever holds completed half-steps.
+        for ind, conn in enumerate(self._conns):
+            (user_lo, user_hi), (song_lo, song_hi) = self._shards['X'][ind], self._shards['Y'][ind]
+
+            conn.send(('setup', {
+                'X':    np.array(self.X[user_lo:user_hi]),
+                'Y':    np.array(self.Y[song_lo:song_hi]),
+            }, {
+                'X':    self._paths['X'][ind],
+                'Y':    self._paths['Y'][ind],
+            }))
+
+        self._grams     = {}
+        self._entries   = None
+
+    def _stop(self):
+        for conn in self._conns:
+            try:
+                conn.send(('stop',))
+                conn.close()
+            except (IOError, EOFError):
+                pass
+
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive(): process.terminate()
+
+        self._conns     = []
+        self._processes = []
+
+    @staticmethod
+    def _recv(conn):
+        # A worker's reply; a worker that failed sends its traceback instead,
+        # raised here as a WorkerError, which is not retried.
+        message = conn.recv()
+        if message[0] == 'error':
+            raise WorkerError("An ALS worker failed:\n{}".format(message[1]))
+        return message
+
+    def _gram(self, mtx):
+        # X^T X or Y^T Y, from the last half-step or else summed from the
+        # workers' blocks.
+        if mtx not in self._grams:
+            for conn in self._conns:
+                conn.send(('gram', mtx))
+            self._grams[mtx] = sum(self._recv(conn)[1] for conn in self._conns)
+
+        return self._grams[mtx]
+
+    def _send_fixed(self, mtx):
+        # Hands each worker the rows of the fixed matrix it references, as
+        # pieces taken from the workers that own them.
+        fixed   = 'Y' if mtx == 'X' else 'X'
+        B       = self.Y if mtx == 'X' else self.X
+
+        for conn, columns in zip(self._conns, self._columns[mtx]):
+            conn.send(('fixed', len(columns), B.shape[1], B.dtype))
+
+            for owner, (lo, hi) in zip(self._conns, self._shards[fixed]):
+                start_ind, end_ind = np.searchsorted(columns, (lo, hi))
+                if start_ind == end_ind: continue
+
+                owner.send(('rows', fixed, columns[start_ind:end_ind] - lo))
+                conn.send(('piece', start_ind, self._recv(owner)[1]))
+
+    def _half_step(self, mtx):
+        A       = self.X if mtx == 'X' else self.Y
+        fixed   = 'Y' if mtx == 'X' else 'X'
+
+        B_T_B_regularized = self._gram(fixed) + self.param_lambda * np.eye(A.shape[1])
+        self._send_fixed(mtx)
+
+        for conn in self._conns:
+            conn.send(('solve', mtx, B_T_B_regularized, self.solver))
+
+        gram    = np.zeros((A.shape[1], A.shape[1]))
+        entries = 0.0
+
+        for conn, (lo, hi) in zip(self._conns, self._shards[mtx]):
+            _, A_block, partial_gram, partial_entries = self._recv(conn)
+
+            A[lo:hi]    = A_block
+            gram       += partial_gram
+            entries    += partial_entries
+
+        self._grams[mtx]    = gram
+        self._entries       = entries
+
+    def half_step(self, mtx):
+        # Updates X or Y. If a worker dies, the workers are restarted from the
+        # last completed half-step and this one is run again.
+        for attempt in xrange(RETRIES + 1):
+            try:
+                return self._half_step(mtx)
+            except (IOError, EOFError) as e:
+                if attempt == RETRIES: raise
+                report("ALS worker lost ({}); restarting workers.".format(e.__class__.__name__))
+                self._stop()
+                self._start()
+
+    def objective(self):
+        # The objective of X and Y as of the last half-step, from the workers'
+        # partial terms; see als.combine_objective.
+        if self._entries is None: raise ParametersError("No half-step has been run yet.")
+
+        return als.combine_objective(self._gram('X'), self._gram('Y'), self._entries, self.param_lambda)
+
+    def close(self):
+        self._stop()
+        self._listener.close()
@@ -0,0 +1,132 @@
+import numpy as np
+from multiprocessing import cpu_count
+from scipy import sparse
+
+from krotos.msd.latent import als, features, parallel, ranking, triplets
+from krotos.debug import report
+
+
+
+MAP_K       = 500
+RECALL_KS   = (10, 50, 100, 500)
+
+def holdout(R, fraction=0.2, seed=0, min_plays=2):
+    # Splits the entries of the user-by-song play matrix R into a training and
+    # a testing matrix. For each user with at least min_plays songs, a random
+    # `fraction` of those songs (at least one) is held out for testing.
+    R       = R.tocsr()
+    counts  = np.diff(R.indptr)
+    rows    = np.repeat(np.arange(R.shape[0]), counts)
+
+    n_test  = np.where(counts >= min_plays, np.maximum(1, (counts * fraction).astype(np.int64)), 0)
+
+    # Rank each user's entries by a random key; the lowest ranks are held out.
+    keys    = np.random.RandomState(seed).rand(R.nnz)
+    order   = np.lexsort((keys, rows))
+    rank    = np.empty(R.nnz, dtype=np.int64)
+    rank[order] = np.arange(R.nnz) - np.repeat(R.indptr[:-1], counts)
+
+    is_test = rank < n_test[rows]
+
+    split = lambda selected: sparse.csr_matrix(
+        (R.data[selected], (rows[selected], R.indices[selected])),
+        shape=R.shape
+    )
+
+    return split(~is_test), split(is_test)
+
+def fit(R, param_lambda=features.LAMBDA, param_alpha=features.ALPHA, param_epsilon=features.EPSILON, f=features.LATENT_FEATURES, rounds=10, solver='block', seed=0):
+    # Latent factors X and Y trained in memory on the play matrix R from a
+    # seeded random start. Unlike LatentFeatures.minimize, nothing is read
+    # from or written to the store, so R can be a training split.
+    C_ui = als.confidence_transform(R.tocsr(), param_alpha, param_epsilon)
+    C_iu = C_ui.transpose(copy=False).tocsr()
+
+    random  = np.random.RandomState(seed)
+    X       = random.rand(R.shape[0], f) * 0.01
+    Y       = random.rand(R.shape[1], f) * 0.01
+
+    for rnd in xrange(rounds):
+        als.update(X, Y, C_ui, param_lambda, solver=solver)
+        als.update(Y, X, C_iu, param_lambda, solver=solver)
+
+    return X, Y
+
+def _score_users(task):
+    start_ind, end_ind, k, recall_ks = task
+    X, Y, train, test, users = (parallel.shared(key) for key in ('X', 'Y', 'train', 'test', 'users'))
+    return score_users(X, Y, train, test, users[start_ind:end_ind], k, recall_ks)
+
+def score_users(X, Y, train, test, users, k=MAP_K, recall_ks=RECALL_KS):
+    # Number of users scored, their summed average precision at k and their
+    # summed recall at each r in recall_ks.
+    scores  = ranking.mask(X[users].dot(Y.T), train[users])
+    idx, _  = ranking.top_k(scores, max((k,) + tuple(recall_ks)))
+
+    # Look up each ranked (user, song) pair among the held out entries.
+    test    = test[users].tocoo()
+    held    = test.row.astype(np.int64) * Y.shape[0] + test.col
+    ranked  = np.arange(len(users), dtype=np.int64)[:, np.newaxis] * Y.shape[0] + idx
+    hits    = np.in1d(ranked.ravel(), held).reshape(idx.shape)
+    n_held  = np.bincount(test.row, minlength=len(users))
+
+    precision   = np.cumsum(hits[:, :k], axis=1) / np.arange(1.0, hits[:, :k].shape[1] + 1)
+    ap          = np.sum(precision * hits[:, :k], axis=1) / np.minimum(k, n_held)
+    recall      = dict((r, np.sum(np.sum(hits[:, :r], axis=1) / n_held.astype(np.float64))) for r in recall_ks)
+
+    return len(users), np.sum(ap), recall
+
+def evaluate(X, Y, train, test, k=MAP_K, recall_ks=RECALL_KS, workers=None):
+    # Ranks every song not played in `train` for each user with held out plays
+    # in `test`, and reports MAP@k (as in the MSD Challenge, McFee et al.
+    # 2012) and recall@r for each r in recall_ks. Users are scored in chunks
+    # of X Y^T across a pool of forked workers.
+    train, test = train.tocsr(), test.tocsr()
+    users       = np.flatnonzero(np.diff(test.indptr))
+    chunk_size  = ranking.chunk_rows(Y.shape[0])
+
+    tasks = [
+        (start_ind, min(start_ind + chunk_size, len(users)), k, recall_ks)
+        for start_ind in xrange(0, len(users), chunk_size)
+    ]
+
+    scored, ap_sum, recall_sum = 0, 0.0, dict((r, 0.0) for r in recall_ks)
+
+    # A single worker scores in this process, which also allows evaluating
+    # from within another pool's worker.
+    if workers == 1:
+        pool    = None
+        chunks  = (score_users(X, Y, train, test, users[task[0]:task[1]], k, recall_ks) for task in tasks)
+    else:
+        pool    = parallel.shared_pool({'X': X, 'Y': Y, 'train': train, 'test': test, 'users': users}, workers or cpu_count())
+        chunks  = pool.imap_unordered(_score_users, tasks)
+
+    try:
+        for n, ap, recall in chunks:
+            scored += n
+            ap_sum += ap
+            for r in recall_ks: recall_sum[r] += recall[r]
+
+            report("{0:7.3f}% of held out users scored...".format(scored * 100.0 / len(users)), sameline=True)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    report('')
+
+    results = {'map@{}'.format(k): ap_sum / max(scored, 1)}
+    results.update(('recall@{}'.format(r), recall_sum[r] / max(scored, 1)) for r in recall_ks)
+
+    return results
+
+def evaluate_store(subset=None, fraction=0.2, seed=0, rounds=10, solver='block', k=MAP_K, recall_ks=RECALL_KS, workers=None):
+    # Evaluates the store's hyperparameters: holds out a fraction of each
+    # user's plays in the store's play matrix, fits factors to the rest and
+    # ranks the held out plays. The store's own factors are trained on every
+    # play by LatentFeatures.minimize, so they cannot be evaluated this way;
+    # to compare other hyperparameters, see sweep.sweep.
+    train, test = holdout(triplets.load_store(subset)[0], fraction=fraction, seed=seed)
+    X, Y        = fit(train, rounds=rounds, solver=solver, seed=seed)
+
+    return evaluate(X, Y, train, test, k=k, recall_ks=recall_ks, workers=workers)
@@ -1,15 +1,16 @@
 import os
 import signal
 import pickle
+import uuid
 import numpy as np
 from scipy import sparse
 
 from krotos.paths import PATHS, mkdir_path
-from krotos.utils import Singleton
-from krotos.msd.db.echonest import EchoNestTasteDB
+from krotos.utils import Singleton, atomic_write
+from krotos.msd.db.echonest import EchoNestTasteDB, unique_ordered
 from krotos.exceptions import ParametersError
 from krotos.debug import report
-from krotos.msd.latent import als
+from krotos.msd.latent import als, ann, distributed, hybrid, idmap, parallel, ranking, recommend
 
 
 
@@ -21,15 +22,40 @@ EPSILON = 1e6
 
 SUBSET = False
 
+# Keep X and Y in memory-mapped .npy files rather than in RAM. Each batch then
+# only writes back the pages of the rows it updated.
+OUT_OF_CORE = False
+OUT_OF_CORE_INIT_ROWS = 100000
+
+# Store latent factors as float32 and the confidence matrix's indices as int32
+# (when they fit), roughly halving X and Y and the index arrays of C. C's
+# entries are kept float32 too, though they already are when built from a
+# float32 play count matrix.
+COMPACT = False
+
+# Plays scattered into the CSR play count matrix at a time.
+CSR_CHUNK = 1 << 22
+
 mkdir_path('msd_echonest_latent')
 STORE_FILES = {
     'shape':    'shape.pickle',
     'X':        'X.npy',
     'Y':        'Y.npy',
     'C':        'C.npz',
-    'progress': 'progress.pickle'
+    'R':        'R.npz',
+    'users':    'users.npy',
+    'songs':    'songs.npy',
+    'progress': 'progress.pickle',
+    'history':  'history.pickle',
+    'refresh':  'refresh.pickle',
+    'ann':      'ann.npz',
+    'hybrid':   'hybrid.npz',
+    'shards':   'shards',
+    'song_map': 'song_map',
+    'user_map': 'user_map',
+    'recommendations':  'recommendations.npy'
 }
-GET_STORE_PATH = lambda x: os.path.join(PATHS['msd_echonest_latent'], ('subset_' if SUBSET else '') + STORE_FILES[x])
+GET_STORE_PATH = lambda x, subset=None: os.path.join(PATHS['msd_echonest_latent'], ('subset_' if (SUBSET if subset is None else subset) else '') + STORE_FILES[x])
 
 
 
@@ -48,6 +74,11 @@ class LatentFeatures(object):
         self._load_confidence_matrix()
         report("Confidence matrix loaded.")
 
+        self._load_ids()
+
+        self._hybrid = None
+        self._invalidate_caches(stale=False)
+
     def _get_hyperparams(self):
         # m: the number of users
         # n: the number of songs
@@ -61,9 +92,15 @@ class LatentFeatures(object):
         # f: the number of latent features
         self.f = LATENT_FEATURES
 
-    def _load(self, path, mode=None):
+    @staticmethod
+    def _load(path, mode=None):
         if not os.path.exists(path): return None
 
+        if mode == 'memmap':
+            return np.load(path, mmap_mode='r+')
+        if mode == 'memmap_readonly':
+            return np.load(path, mmap_mode='r')
+
         with open(path, 'rb') as f:
             if mode == 'ndarray':
                 return np.load(f)
@@ -73,13 +110,26 @@ class LatentFeatures(object):
                     (obj['data'], (obj['row'], obj['col'])),
                     shape=obj['shape']
                 )
+            elif mode == 'sparse':
+                # Either a CSR or a COO matrix, as saved.
+                obj = np.load(f)
+                if 'indptr' in obj:
+                    return sparse.csr_matrix(
+                        (obj['data'], obj['indices'], obj['indptr']),
+                        shape=obj['shape']
+                    )
+                return sparse.coo_matrix(
+                    (obj['data'], (obj['row'], obj['col'])),
+                    shape=obj['shape']
+                )
             else:
                 return pickle.load(f)
 
-    def _save(self, path, obj, mode=None):
+    @staticmethod
+    def _save(path, obj, mode=None, token=None):
         s = signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-        with open(path, 'wb') as f:
+        with atomic_write(path) as tmp_path, open(tmp_path, 'wb') as f:
             if mode == 'ndarray':
                 np.save(f, obj)
             elif mode == 'COO':
@@ -90,48 +140,194 @@ class LatentFeatures(object):
                     col=obj.col,
                     shape=obj.shape
                 )
+            elif mode == 'CSR':
+                # token: that of the refresh the matrix was saved by.
+                arrays = dict(data=obj.data, indices=obj.indices, indptr=obj.indptr, shape=obj.shape)
+                if token is not None: arrays['token'] = token
+                np.savez(f, **arrays)
             else:
                 pickle.dump(obj, f)
 
         signal.signal(signal.SIGINT, s)
 
+    def _factor_dtype(self):
+        return np.float32 if COMPACT else np.float64
+
     def _load_latents(self):
-        # X: m-by-f matrix of user latent feature row vectors
-        self.X = self._load(GET_STORE_PATH('X'), mode='ndarray')
+        mode = 'memmap' if OUT_OF_CORE else 'ndarray'
 
-        if self.X is None:
-            self.X = np.random.rand(self.m, self.f) * 0.01
-            self._save(GET_STORE_PATH('X'), self.X, mode='ndarray')
+        # X: m-by-f matrix of user latent feature row vectors
+        self.X = self._load(GET_STORE_PATH('X'), mode=mode)
+        if self.X is None: self.X = self._init_latents(GET_STORE_PATH('X'), self.m)
 
         # Y: n-by-f matrix of song latent feature row vectors
-        self.Y = self._load(GET_STORE_PATH('Y'), mode='ndarray')
+        self.Y = self._load(GET_STORE_PATH('Y'), mode=mode)
+        if self.Y is None: self.Y = self._init_latents(GET_STORE_PATH('Y'), self.n)
+
+        # Matrices saved at another precision are converted once in RAM; memory
+        # maps keep the dtype they were created with.
+        if not OUT_OF_CORE:
+            self.X = self.X.astype(self._factor_dtype(), copy=False)
+            self.Y = self.Y.astype(self._factor_dtype(), copy=False)
+
+    def _init_latents(self, path, rows):
+        if not OUT_OF_CORE:
+            A = (np.random.rand(rows, self.f) * 0.01).astype(self._factor_dtype())
+            self._save(path, A, mode='ndarray')
+            return A
+
+        # Fill the new file a slice at a time so the matrix is never held in
+        # memory whole, then move it into place.
+        with atomic_write(path) as tmp_path:
+            A = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self._factor_dtype(), shape=(rows, self.f))
 
-        if self.Y is None:
-            self.Y = np.random.rand(self.n, self.f) * 0.01
-            self._save(GET_STORE_PATH('Y'), self.Y, mode='ndarray')
+            for start_ind in xrange(0, rows, OUT_OF_CORE_INIT_ROWS):
+                end_ind = min(start_ind + OUT_OF_CORE_INIT_ROWS, rows)
+                A[start_ind:end_ind] = np.random.rand(end_ind - start_ind, self.f) * 0.01
+
+            A.flush()
+            del A
+
+        return self._load(path, mode='memmap')
 
     def _save_latents(self, mtx):
-        if mtx == 'X': self._save(GET_STORE_PATH('X'), self.X, mode='ndarray')
-        if mtx == 'Y': self._save(GET_STORE_PATH('Y'), self.Y, mode='ndarray')
+        A = self.X if mtx == 'X' else self.Y
+
+        # Memory-mapped matrices are updated in place; flushing writes back
+        # only the dirty pages, i.e. the rows of the last batch.
+        if isinstance(A, np.memmap):
+            A.flush()
+            return
+
+        self._save(GET_STORE_PATH(mtx), A, mode='ndarray')
+
+    def _load_ids(self):
+        # Song ids by index for stores built from train_triplets.txt (sorted,
+        # then any added by refresh); None when the ids live in the SQLite
+        # vector_songs table.
+        self._song_ids = self._load(GET_STORE_PATH('songs'), mode='ndarray')
+
+    def song_id_map(self):
+        if self._song_id_map is None:
+            self._song_id_map = idmap.IdMap.load_or_build(GET_STORE_PATH('song_map'), self._song_ids, self._echonest.get_song_ids, self.n)
+        return self._song_id_map
+
+    def user_id_map(self):
+        if self._user_id_map is None:
+            user_ids = self._load(GET_STORE_PATH('users'), mode='memmap_readonly')
+            self._user_id_map = idmap.IdMap.load_or_build(GET_STORE_PATH('user_map'), user_ids, self._echonest.get_user_ids, self.m)
+        return self._user_id_map
+
+    def _get_track_idx(self, track_id_echonest):
+        return self.song_id_map().get_idx(track_id_echonest)
+
+    def _get_track_ids(self, idxs):
+        return self.song_id_map().get_ids(idxs), idxs
+
+    def _extend_latents(self, mtx, rows):
+        # Appends randomly initialized rows to X or Y, as for a new matrix.
+        A       = self.X if mtx == 'X' else self.Y
+        path    = GET_STORE_PATH(mtx)
+        old     = A.shape[0]
+
+        if rows <= old: return
+
+        if isinstance(A, np.memmap):
+            # Memory maps cannot grow in place; copy into a larger file and
+            # move it into place.
+            with atomic_write(path) as tmp_path:
+                extended = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=A.dtype, shape=(rows, self.f))
+
+                for start_ind in xrange(0, old, OUT_OF_CORE_INIT_ROWS):
+                    end_ind = min(start_ind + OUT_OF_CORE_INIT_ROWS, old)
+                    extended[start_ind:end_ind] = A[start_ind:end_ind]
+                extended[old:] = np.random.rand(rows - old, self.f) * 0.01
+
+                extended.flush()
+                del extended
+
+            extended = self._load(path, mode='memmap')
+        else:
+            extended = np.vstack((A, np.random.rand(rows - old, self.f) * 0.01)).astype(A.dtype, copy=False)
+            self._save(path, extended, mode='ndarray')
+
+        setattr(self, mtx, extended)
 
     def _load_confidence_matrix(self):
-        C = self._load(GET_STORE_PATH('C'), mode='COO')
+        self.C_ui = self._load(GET_STORE_PATH('C'), mode='sparse')
+
+        if self.C_ui is None:
+            # Stores built from train_triplets.txt (see triplets.py) carry
+            # their play counts; otherwise they come from SQLite.
+            R = self._load(GET_STORE_PATH('R'), mode='sparse')
+            if R is None: R = self._get_plays_matrix(mode='CSR')
+
+            self.C_ui = als.confidence_transform(R, ALPHA, EPSILON, copy=False)
+            del R
+            self._save(GET_STORE_PATH('C'), self.C_ui, mode='CSR')
+
+        self._set_confidence_matrix()
+
+    def _set_confidence_matrix(self):
+        # Compacts self.C_ui, converting it to CSR and padding it to m-by-n,
+        # and builds its transpose. Callers assign C_ui without keeping a
+        # reference of their own, so the replaced (e.g. COO) matrix is freed
+        # as soon as the CSR one exists and at most two copies of the
+        # confidence entries are alive at once: during the conversion, then
+        # C_ui and C_iu.
+        self.C_iu = None
+        self.C_ui = self._compact(self._padded(self.C_ui.tocsr()))
+        self.C_iu = self._compact(self.C_ui.transpose(copy=False).tocsr())
+
+    def _padded(self, C, shape=None):
+        # A CSR matrix with empty rows and columns appended up to shape,
+        # m-by-n by default. A refresh that extended X and Y but then failed,
+        # or crashed before C was saved, leaves the saved C smaller than them.
+        shape = shape or (self.m, self.n)
+        if C.shape == shape: return C
+
+        return sparse.csr_matrix(
+            (C.data, C.indices, np.concatenate((C.indptr, np.repeat(C.indptr[-1], shape[0] - C.shape[0])))),
+            shape=shape
+        )
+
+    def _compact(self, C):
+        if not COMPACT: return C
+
+        C.data = C.data.astype(np.float32, copy=False)
+
+        # As in _load_plays_matrix_CSR, int32 only while nnz and n fit.
+        if max(C.nnz, C.shape[1]) < np.iinfo(np.int32).max:
+            C.indices   = C.indices.astype(np.int32, copy=False)
+            C.indptr    = C.indptr.astype(np.int32, copy=False)
+        return C
+
+    def memory_usage(self):
+        # Bytes held by each latent and confidence matrix.
+        usage = {
+            'X':    self.X.nbytes,
+            'Y':    self.Y.nbytes,
+            'C_ui': self.C_ui.data.nbytes + self.C_ui.indices.nbytes + self.C_ui.indptr.nbytes,
+            'C_iu': self.C_iu.data.nbytes + self.C_iu.indices.nbytes + self.C_iu.indptr.nbytes,
+        }
 
-        if C is None:
-            C = als.confidence_transform(self._get_plays_matrix(mode='COO'), ALPHA, EPSILON)
-            self._save(GET_STORE_PATH('C'), C, mode='COO')
+        for name in sorted(usage):
+            mapped = isinstance(getattr(self, name), np.memmap)
+            report("{0:5s} {1:12.3f} MiB{2}".format(name, usage[name] / 2.0 ** 20, ' (memory-mapped)' if mapped else ''))
 
-        self.C_ui = C.tocsr()
-        self.C_iu = C.transpose(copy=False).tocsr()
+        return usage
 
-    def _get_plays_matrix(self, mode='COO'):
+    def _get_plays_matrix(self, mode='CSR'):
         # Load this data to generate confidence matrices and prediction vectors
-        # in later computation. Always returns a COO matrix.
+        # in later computation. Returns a CSR matrix in CSR mode, otherwise a
+        # COO matrix.
 
         if mode == 'LIL':
             return self._load_plays_matrix_LIL()
         if mode == 'COO':
             return self._load_plays_matrix_COO()
+        if mode == 'CSR':
+            return self._load_plays_matrix_CSR()
 
     def _load_plays_matrix_COO(self):
         report("COO mode: Extracting SQLite dump.")
@@ -140,6 +336,48 @@ class LatentFeatures(object):
         report("COO mode: Extraction done, creating play count matrix.")
         return sparse.coo_matrix((playcount, (user, song)), shape=(self.m, self.n))
 
+    def _load_plays_matrix_CSR(self):
+        report("CSR mode: Extracting SQLite dump.")
+        user, song, playcount = self._echonest.get_all_playcounts()
+
+        report("CSR mode: Extraction done, creating play count matrix.")
+        # Row pointers come from a counting pass over the user ids. Entries
+        # are then scattered straight into their rows a chunk at a time, so
+        # besides the fetched columns only the CSR arrays are allocated.
+        nnz         = len(user)
+        idx_dtype   = np.int32 if max(nnz, self.n) < np.iinfo(np.int32).max else np.int64
+
+        indptr  = np.zeros(self.m + 1, dtype=idx_dtype)
+        np.cumsum(np.bincount(user, minlength=self.m), out=indptr[1:])
+
+        indices = np.empty(nnz, dtype=idx_dtype)
+        data    = np.empty(nnz, dtype=playcount.dtype)
+        cursor  = indptr[:-1].astype(np.int64)
+
+        for start_ind in xrange(0, nnz, CSR_CHUNK):
+            end_ind = min(start_ind + CSR_CHUNK, nnz)
+            rows    = user[start_ind:end_ind]
+
+            # Rank of each entry among the chunk's entries of the same row.
+            order           = np.argsort(rows, kind='mergesort')
+            sorted_rows     = rows[order]
+            rank            = np.empty(len(rows), dtype=np.int64)
+            rank[order]     = np.arange(len(rows)) - np.searchsorted(sorted_rows, sorted_rows)
+
+            pos             = cursor[rows] + rank
+            indices[pos]    = song[start_ind:end_ind]
+            data[pos]       = playcount[start_ind:end_ind]
+            cursor         += np.bincount(rows, minlength=self.m)
+
+            report("{:7.3f}% of plays placed.".format(end_ind * 100.0 / nnz), sameline=True)
+
+        report('')
+        del user, song, playcount
+
+        R = sparse.csr_matrix((data, indices, indptr), shape=(self.m, self.n), copy=False)
+        R.sum_duplicates()
+        return R
+
     def _load_plays_matrix_LIL(self):
         # LIL matrices are row-slice efficent, esp. when row indices are ordered
         # Get data by user incrementally
@@ -160,18 +398,26 @@ class LatentFeatures(object):
         for i in xrange(C_ab.indptr[A_row_ind], C_ab.indptr[A_row_ind + 1]):
             yield C_ab.data[i], C_ab.indices[i]
 
-    def _update_matrix(self, A, B, C_ab, param_lambda, start_ind=0, end_ind=None):
+    def _update_matrix(self, A, B, C_ab, param_lambda, start_ind=0, end_ind=None, solver='block'):
         rows        = A.shape[0]
         end_ind     = min(end_ind or rows, rows)
         batch_size  = end_ind - start_ind
 
-        B_T_B_regularized =  B.T.dot(B) + (param_lambda * np.eye(self.f))
+        B_T_B_regularized = als.regularized_gram(B, param_lambda)
 
-        for A_row_ind in xrange(start_ind, end_ind):
-            self._update_vector(A, B, C_ab, B_T_B_regularized, A_row_ind)
+        if solver == 'vector':
+            for A_row_ind in xrange(start_ind, end_ind):
+                self._update_vector(A, B, C_ab, B_T_B_regularized, A_row_ind)
 
-            if A_row_ind % 100 == 0:
-                report("{0:7.3f}% of latent feature matrix updated... ({1:.3f}% of batch complete)".format(A_row_ind * 100.0 / rows, (A_row_ind - start_ind) * 100.0 / batch_size), sameline=True)
+                if A_row_ind % 100 == 0:
+                    report("{0:7.3f}% of latent feature matrix updated... ({1:.3f}% of batch complete)".format(A_row_ind * 100.0 / rows, (A_row_ind - start_ind) * 100.0 / batch_size), sameline=True)
+        elif solver in als.SOLVERS:
+            def progress(block_end):
+                report("{0:7.3f}% of latent feature matrix updated... ({1:.3f}% of batch complete)".format(block_end * 100.0 / rows, (block_end - start_ind) * 100.0 / batch_size), sameline=True)
+
+            als.solve_rows(A, B, C_ab, B_T_B_regularized, start_ind, end_ind, solver, progress)
+        else:
+            raise ParametersError("Unknown solver '{}'; expected 'vector' or one of {}.".format(solver, sorted(als.SOLVERS)))
 
     def _update_vector(self, A, B, C_ab, B_T_B_regularized, A_row_ind):
         left    = B_T_B_regularized.copy()
@@ -184,6 +430,18 @@ class LatentFeatures(object):
 
         A[A_row_ind]  = np.linalg.solve(left, right)
 
+    def _update_rows(self, A, B, C_ab, param_lambda, rows, solver='block'):
+        # Like _update_matrix, for an arbitrary set of rows of A.
+        if solver not in als.SOLVERS:
+            raise ParametersError("Unknown solver '{}'; expected one of {}.".format(solver, sorted(als.SOLVERS)))
+
+        C_rows = C_ab[rows]
+        A_rows = A[rows]
+
+        als.solve_rows(A_rows, B, C_rows, als.regularized_gram(B, param_lambda), 0, len(rows), solver)
+
+        A[rows] = A_rows
+
     def _load_progress(self):
         self.progress = self._load(GET_STORE_PATH('progress')) or {
             'rnd':  0,
@@ -195,20 +453,83 @@ class LatentFeatures(object):
         self.progress.update(kwargs)
         self._save(GET_STORE_PATH('progress'), self.progress)
 
-    def minimize(self, rounds=1, batch_size=20000):
+    def _load_history(self):
+        # Maps each completed round to the objective measured after it.
+        self.history = self._load(GET_STORE_PATH('history')) or {}
+
+    def _save_history(self, rnd, loss):
+        self.history[rnd] = loss
+        self._save(GET_STORE_PATH('history'), self.history)
+
+    def objective(self):
+        return als.objective(self.X, self.Y, self.C_ui, LAMBDA)
+
+    def _converged(self, rnd, tolerance):
+        if tolerance is None or (rnd - 1) not in self.history: return False
+
+        previous    = self.history[rnd - 1]
+        improvement = (previous - self.history[rnd]) / abs(previous)
+        report("Objective {0:.6e} ({1:.3e} relative improvement).".format(self.history[rnd], improvement))
+
+        # A rising objective means minimization is diverging, not converging.
+        if improvement < 0:
+            report("Objective increased in round {}; not treating it as converged.".format(rnd + 1))
+            return False
+
+        return improvement < tolerance
+
+    def _share(self):
+        # Move the latent and confidence matrices into shared memory, so that
+        # forked workers can update X and Y in place.
+        self.X      = parallel.to_shared(self.X)
+        self.Y      = parallel.to_shared(self.Y)
+        self.C_ui   = parallel.to_shared_csr(self.C_ui)
+        self.C_iu   = parallel.to_shared_csr(self.C_iu)
+
+        return {'X': self.X, 'Y': self.Y, 'C_ui': self.C_ui, 'C_iu': self.C_iu}
+
+    def _update_batch(self, updater, mtx, start_ind, end_ind, solver):
+        if updater is not None:
+            updater.update_matrix(mtx, LAMBDA, start_ind=start_ind, end_ind=end_ind, solver=solver)
+        elif mtx == 'X':
+            self._update_matrix(self.X, self.Y, self.C_ui, LAMBDA, start_ind=start_ind, end_ind=end_ind, solver=solver)
+        elif mtx == 'Y':
+            self._update_matrix(self.Y, self.X, self.C_iu, LAMBDA, start_ind=start_ind, end_ind=end_ind, solver=solver)
+
+    def minimize(self, rounds=1, batch_size=20000, solver='block', workers=1, tolerance=None):
+        # With workers > 1, each batch is sharded across a pool of forked
+        # processes. Checkpoints are still taken once per batch, so progress
+        # saved by either mode can be resumed by the other.
+        #
+        # The objective is recorded after every round. With a tolerance,
+        # minimization stops early once a round improves it by less than that
+        # fraction.
+        #
+        # Every play is trained on, so there are none held out to evaluate the
+        # result against; evaluation.evaluate_store measures the same
+        # hyperparameters on a training split instead.
+        if workers > 1 and solver not in als.SOLVERS:
+            raise ParametersError("Parallel minimization requires one of {}.".format(sorted(als.SOLVERS)))
+
         self._load_progress()
+        self._load_history()
 
+        updater = parallel.SharedUpdater(self._share(), workers) if workers > 1 else None
+
+        try:
+            self._minimize(rounds, batch_size, solver, updater, tolerance)
+        finally:
+            if updater is not None: updater.close()
+            self._invalidate_caches()
+
+    def _minimize(self, rounds, batch_size, solver, updater, tolerance):
         for rnd in xrange(self.progress['rnd'], rounds):
             report("Round {} of minimization...".format(rnd + 1))
 
             if self.progress['mtx'] == 'X':
                 report("Updating matrix X of user latent feature vectors.")
                 while(self.progress['idx'] < self.m):
-                    self._update_matrix(
-                        self.X, self.Y, self.C_ui, LAMBDA,
-                        start_ind   = self.progress['idx'],
-                        end_ind     = self.progress['idx'] + batch_size
-                    )
+                    self._update_batch(updater, 'X', self.progress['idx'], self.progress['idx'] + batch_size, solver)
                     self._save_latents('X')
                     self._save_progress(idx=(self.progress['idx'] + batch_size))
 
@@ -218,34 +539,462 @@ class LatentFeatures(object):
             if self.progress['mtx'] == 'Y':
                 report("Updating matrix Y of song latent feature vectors.")
                 while(self.progress['idx'] < self.n):
-                    self._update_matrix(
-                        self.Y, self.X, self.C_iu, LAMBDA,
-                        start_ind   = self.progress['idx'],
-                        end_ind     = self.progress['idx'] + batch_size
-                    )
+                    self._update_batch(updater, 'Y', self.progress['idx'], self.progress['idx'] + batch_size, solver)
                     self._save_latents('Y')
                     self._save_progress(idx=(self.progress['idx'] + batch_size))
 
                     report('')
                 self._save_progress(mtx='X', idx=0)
 
+            self._save_history(rnd, self.objective())
             self._save_progress(rnd=(rnd + 1))
 
+            if self._converged(rnd, tolerance):
+                report("Minimization converged after round {}.".format(rnd + 1))
+                break
+
+    def refresh(self, user_ids, song_ids, counts, neighborhood=0, rounds=1, solver='block'):
+        # Adds new plays given as Echo Nest (user, song, count) triplets, then
+        # re-solves only the affected latent vectors. Unseen users and songs
+        # are appended to X and Y. Counts add to any existing plays.
+        #
+        # The re-solved rows are the users and songs of the new triplets,
+        # widened by `neighborhood` hops through the confidence matrix: the
+        # first hop adds every song the affected users played, the second
+        # every user of those songs, and so on.
+        #
+        # The triplets are logged to the store before any of it changes, and
+        # the log is removed once they are all in; a refresh interrupted in
+        # between is completed by the next one. See _apply_refresh.
+        self._finish_refresh()
+        if not len(user_ids): return
+
+        pending = {
+            'token':    uuid.uuid4().hex,
+            'user_ids': np.asarray(user_ids),
+            'song_ids': np.asarray(song_ids),
+            'counts':   np.asarray(counts, dtype=np.float64),
+        }
+        if self._song_ids is None: pending['last_play'] = self._echonest.get_last_play()
+        self._save(GET_STORE_PATH('refresh'), pending)
+
+        users, songs = self._apply_refresh(pending)
+
+        users = np.unique(users)
+        songs = np.unique(songs)
+
+        for hop in xrange(neighborhood):
+            if hop % 2 == 0:
+                songs = np.union1d(songs, self.C_ui[users].indices)
+            else:
+                users = np.union1d(users, self.C_iu[songs].indices)
+
+        report("Refreshing {} user and {} song latent feature vectors.".format(len(users), len(songs)))
+
+        for rnd in xrange(rounds):
+            self._update_rows(self.X, self.Y, self.C_ui, LAMBDA, users, solver=solver)
+            self._save_latents('X')
+
+            self._update_rows(self.Y, self.X, self.C_iu, LAMBDA, songs, solver=solver)
+            self._save_latents('Y')
+
+        self._invalidate_caches()
+
+    def _finish_refresh(self):
+        # Adds the plays of a refresh that was interrupted after logging
+        # them; its latent vectors are left to be re-solved later.
+        pending = self._load(GET_STORE_PATH('refresh'))
+        if pending is None: return
+
+        report("Completing an interrupted refresh of {} plays.".format(len(pending['counts'])))
+        self._apply_refresh(pending)
+        self._invalidate_caches()
+
+    def _apply_refresh(self, pending):
+        # Adds logged plays to the store and the ids, then removes the log.
+        # Each file is written along with the log's token, and left alone by
+        # a rerun that finds the token in it already, so running this again
+        # after a crash at any point adds every play exactly once.
+        if self._song_ids is not None:
+            users, songs = self._add_store_plays(pending)
+        else:
+            users, songs = self._add_sqlite_plays(pending)
+
+        os.remove(GET_STORE_PATH('refresh'))
+
+        return users, songs
+
+    def _add_sqlite_plays(self, pending):
+        # The plays are committed to SQLite only once the store has been
+        # extended and C saved. Plays are only ever appended to SQLite, so if
+        # its newest play is past the one logged, they were committed.
+        user_ids, song_ids, counts = pending['user_ids'], pending['song_ids'], pending['counts']
+
+        if self._echonest.get_last_play() > pending['last_play']:
+            users, user_inverse = np.unique(user_ids, return_inverse=True)
+            songs, song_inverse = np.unique(song_ids, return_inverse=True)
+            return self._echonest.get_user_idxs(users)[user_inverse], self._echonest.get_song_idxs(songs)[song_inverse]
+
+        users, songs = self._echonest.add_playcounts(user_ids, song_ids, counts, commit=False)
+
+        try:
+            self._add_plays(users, songs, counts, pending['token'])
+        except:
+            self._echonest.rollback()
+            raise
+
+        self._echonest.commit()
+
+        return users, songs
+
+    def _add_store_plays(self, pending):
+        # As _add_sqlite_plays, for stores built from train_triplets.txt:
+        # unseen ids are appended to users.npy and songs.npy, and the plays
+        # are added to R as well as C. The id arrays are saved last, in place
+        # of the SQLite commit; until then a rerun gives unseen ids the same
+        # indices again.
+        users, new_user_ids = self._store_idxs(self.user_id_map(), pending['user_ids'])
+        songs, new_song_ids = self._store_idxs(self.song_id_map(), pending['song_ids'])
+
+        self._add_plays(users, songs, pending['counts'], pending['token'], with_R=True)
+
+        if len(new_user_ids):
+            self._save(GET_STORE_PATH('users'), np.concatenate((self.user_id_map().ids, new_user_ids)), mode='ndarray')
+        if len(new_song_ids):
+            self._song_ids = np.concatenate((self._song_ids, new_song_ids))
+            self._save(GET_STORE_PATH('songs'), self._song_ids, mode='ndarray')
+
+        self._song_id_map = None
+        self._user_id_map = None
+
+        return users, songs
+
+    @staticmethod
+    def _store_idxs(id_map, ids):
+        # Index of each id in id_map, with unseen ids given the next free
+        # indices in order of first appearance, and the unseen ids in that
+        # order.
+        ids     = np.asarray(ids, dtype=id_map.ids.dtype)
+        idxs    = id_map.get_idxs(ids)
+        unseen  = idxs < 0
+
+        new_ids = np.array(list(unique_ordered(ids[unseen])), dtype=ids.dtype)
+        if len(new_ids):
+            idxs[unseen] = len(id_map) + idmap.IdMap.from_ids(new_ids).get_idxs(ids[unseen])
+
+        return idxs, new_ids
+
+    @staticmethod
+    def _saved_token(path):
+        # The refresh token a sparse matrix was last saved with, if any.
+        if not os.path.exists(path): return None
+
+        with open(path, 'rb') as f:
+            obj = np.load(f)
+            return str(obj['token']) if 'token' in obj else None
+
+    def _add_plays(self, users, songs, counts, token, with_R=False):
+        # Extends the store to the given user and song indices and adds the
+        # play counts to R (with_R, if the store has it) and C, each saved
+        # with token unless it already was. Only the touched entries are
+        # recomputed: from R's updated counts when it is there, so they never
+        # drift, or else from the counts C's confidences map back to. If
+        # anything fails before C is saved, C is reloaded from its untouched
+        # file, so that self.C_ui does not keep plays the caller is about to
+        # roll back; X and Y keep any new rows, and C is padded to them.
+        try:
+            m = max(self.m, users.max() + 1)
+            n = max(self.n, songs.max() + 1)
+
+            self._extend_latents('X', m)
+            self._extend_latents('Y', n)
+            self.m, self.n = m, n
+            self._save(GET_STORE_PATH('shape'), (m, n))
+
+            delta = sparse.coo_matrix((np.asarray(counts, dtype=np.float64), (users, songs)), shape=(m, n))
+            delta.sum_duplicates()
+            users, songs = delta.row, delta.col
+
+            plays   = None
+            R       = self._load(GET_STORE_PATH('R'), mode='sparse') if with_R else None
+            if R is not None:
+                R       = self._padded(R.tocsr())
+                plays   = np.asarray(R[users, songs], dtype=np.float64).ravel()
+
+                if self._saved_token(GET_STORE_PATH('R')) != token:
+                    plays  += delta.data
+                    R       = self._set_entries(R, users, songs, plays)
+                    self._save(GET_STORE_PATH('R'), R, mode='CSR', token=token)
+                del R
+
+            # C was saved with these plays before an interruption, and loaded
+            # with them since.
+            if self._saved_token(GET_STORE_PATH('C')) == token:
+                self.C_ui = self._padded(self.C_ui)
+                self.C_iu = self._padded(self.C_iu, (n, m))
+                return
+
+            C_ui = self._padded(self.C_ui)
+            if plays is None:
+                plays = als.confidence_inverse(np.asarray(C_ui[users, songs]).ravel(), ALPHA, EPSILON) + delta.data
+            conf = als.confidence(plays, ALPHA, EPSILON)
+
+            self.C_iu = self._compact(self._set_entries(self._padded(self.C_iu, (n, m)), songs, users, conf))
+            self.C_ui = None
+            self.C_ui = self._compact(self._set_entries(C_ui, users, songs, conf))
+            del C_ui
+
+            self._save(GET_STORE_PATH('C'), self.C_ui, mode='CSR', token=token)
+        except:
+            self.C_ui = self.C_iu = None
+            self._load_confidence_matrix()
+            raise
+
+    @staticmethod
+    def _set_entries(C, rows, cols, values):
+        # C (CSR) with the entries at (rows, cols) set to values, inserted
+        # where missing. Only the touched rows are rebuilt; the others are
+        # copied over unchanged.
+        touched = np.unique(rows)
+        block   = C[touched].tocoo()
+
+        # Existing entries of the touched rows that are not being set.
+        n_cols  = np.int64(C.shape[1])
+        keep    = ~np.in1d(touched[block.row] * n_cols + block.col, rows * n_cols + cols)
+
+        block = sparse.csr_matrix(
+            (
+                np.concatenate((block.data[keep], values)).astype(C.dtype, copy=False),
+                (np.concatenate((block.row[keep], np.searchsorted(touched, rows))), np.concatenate((block.col[keep], cols)))
+            ),
+            shape=(len(touched), C.shape[1])
+        )
+        block.sort_indices()
+
+        # Entries move to their row's new offset; untouched rows keep their
+        # order, touched rows take the block's entries.
+        old_counts          = np.diff(C.indptr)
+        new_counts          = old_counts.copy()
+        new_counts[touched] = np.diff(block.indptr)
+
+        untouched           = np.ones(C.shape[0], dtype=bool)
+        untouched[touched]  = False
+
+        indptr  = np.concatenate(([0], np.cumsum(new_counts, dtype=np.int64)))
+        if indptr[-1] <= np.iinfo(C.indptr.dtype).max: indptr = indptr.astype(C.indptr.dtype)
+        data    = np.empty(indptr[-1], dtype=C.data.dtype)
+        indices = np.empty(indptr[-1], dtype=C.indices.dtype)
+
+        src     = np.repeat(untouched, old_counts)
+        dest    = np.repeat(untouched, new_counts)
+        data[dest], indices[dest]   = C.data[src], C.indices[src]
+        data[~dest], indices[~dest] = block.data, block.indices
+
+        return sparse.csr_matrix((data, indices, indptr), shape=C.shape)
+
+    def _invalidate_caches(self, stale=True):
+        # Derived from Y; rebuilt on demand once Y has changed. Unless told Y
+        # is unchanged (stale=False), the saved ANN index is removed as well,
+        # rather than left for its fingerprint to catch.
+        if stale and os.path.exists(GET_STORE_PATH('ann')):
+            os.remove(GET_STORE_PATH('ann'))
+
+        self._fold_in_gram  = None
+        self._ann           = None
+        self._Y_normalized  = None
+        self._Y_norms       = None
+
+        # Rows may have been added along with Y's.
+        self._song_id_map   = None
+        self._user_id_map   = None
+
+        # The hybrid index also holds vectors not derived from Y, so it is
+        # kept and only brought up to date with Y.
+        if self._hybrid is not None:
+            self._hybrid.sync(self.song_id_map().ids, self.Y, source='cf')
+
+    def fold_in(self, song_idxs, counts):
+        # Latent vector of a user unseen in training, from the indices of the
+        # songs they played and the play counts.
+        R = sparse.csr_matrix((counts, (np.zeros(len(song_idxs), dtype=np.int32), song_idxs)), shape=(1, self.n))
+        return self.fold_in_batch(R)[0]
+
+    def fold_in_batch(self, R):
+        # Latent vectors for each row of R, a sparse users-by-n matrix of play
+        # counts, by one regularized solve per user against the fixed Y. This
+        # is the user half-step of minimization, without touching X.
+        if self._fold_in_gram is None:
+            self._fold_in_gram = als.regularized_gram(self.Y, LAMBDA)
+
+        C       = als.confidence_transform(sparse.csr_matrix(R), ALPHA, EPSILON)
+        X_new   = np.empty((C.shape[0], self.f), dtype=self.Y.dtype)
+
+        als.solve_rows(X_new, self.Y, C, self._fold_in_gram, 0, C.shape[0])
+        return X_new
+
+    def minimize_distributed(self, rounds=1, workers=2, solver='block', tolerance=None, address=('localhost', 0), spawn=True, authkey=None):
+        # Like minimize, with row shards of X, Y, C_ui and C_iu spread over
+        # socket-connected workers (see distributed.Coordinator). The shards
+        # of C are written to the store for the workers to load, and C is
+        # released here until minimization ends. Progress is checkpointed
+        # after each half-step in the same format as minimize; a half-step
+        # interrupted mid-way is redone from its start. Remote workers
+        # (spawn=False) must be started with the same authkey.
+        if solver not in als.SOLVERS:
+            raise ParametersError("Distributed minimization requires one of {}.".format(sorted(als.SOLVERS)))
+
+        self._load_progress()
+        self._load_history()
+
+        layout = distributed.write_shards(self.C_ui, self.C_iu, workers, GET_STORE_PATH('shards'))
+        self.C_ui = self.C_iu = None
+
+        try:
+            coordinator = distributed.Coordinator(
+                self.X, self.Y, layout, LAMBDA,
+                solver=solver, address=address, spawn=spawn, authkey=authkey
+            )
+
+            try:
+                for rnd in xrange(self.progress['rnd'], rounds):
+                    report("Round {} of distributed minimization...".format(rnd + 1))
+
+                    for mtx, following in (('X', 'Y'), ('Y', 'X')):
+                        if self.progress['mtx'] != mtx: continue
+
+                        report("Updating matrix {}.".format(mtx))
+                        coordinator.half_step(mtx)
+                        self._save_latents(mtx)
+                        self._save_progress(mtx=following, idx=0)
+
+                    # Every round ends with a Y half-step, whose partial terms
+                    # give the objective.
+                    self._save_history(rnd, coordinator.objective())
+                    self._save_progress(rnd=(rnd + 1))
+
+                    if self._converged(rnd, tolerance):
+                        report("Minimization converged after round {}.".format(rnd + 1))
+                        break
+            finally:
+                coordinator.close()
+        finally:
+            self._load_confidence_matrix()
+            self._invalidate_caches()
+
+    def recommend_all(self, n=recommend.RECOMMENDATIONS, workers=None):
+        # Writes every user's top n unplayed songs to the store.
+        return recommend.recommend_all(
+            self.X, self.Y, self.C_ui,
+            GET_STORE_PATH('recommendations'),
+            n=n, workers=workers
+        )
+
+    def recommendations(self, user_idx):
+        # Song indices and scores last written by recommend_all for a user.
+        idx, score = recommend.load(GET_STORE_PATH('recommendations'))
+        valid = idx[user_idx] >= 0
+        return idx[user_idx][valid], score[user_idx][valid]
+
     def get(self, track_id_echonest):
-        idx = self._echonest.get_track_idx(track_id_echonest)
+        idx = self._get_track_idx(track_id_echonest)
         if idx == None: return None, None
         return self.Y[idx, :], idx
 
-    def closest(self, features, n=5, ordered=False):
-        features_norm   = np.linalg.norm(features)
-        song_norm       = np.linalg.norm(self.Y, axis=1)
-
-        r = np.dot(self.Y, features) / (song_norm * features_norm)
-        closest_idx = np.argpartition(r, -n)[-n:]
-
-        track_ids_echonest, idxs = self._echonest.get_track_ids(closest_idx)
+    def ann_index(self, rebuild=False, n_lists=None):
+        # The approximate nearest neighbor index over Y, loaded from the store
+        # or built (and saved) if missing. Updates to Y remove the saved index
+        # (see _invalidate_caches); its fingerprint is only a backstop.
+        if self._ann is None and not rebuild:
+            self._ann = ann.IVFIndex.load(GET_STORE_PATH('ann'), self.Y)
+
+        if self._ann is None or rebuild:
+            self._ann = ann.IVFIndex.build(self.Y, n_lists=n_lists)
+            self._ann.save(GET_STORE_PATH('ann'))
+
+        return self._ann
+
+    def _normalized_latents(self):
+        if self._Y_normalized is None:
+            self._Y_norms       = np.linalg.norm(self.Y, axis=1)
+            self._Y_normalized  = self.Y / np.where(self._Y_norms > 0, self._Y_norms, 1)[:, np.newaxis]
+
+        return self._Y_normalized, self._Y_norms
+
+    def song_norms(self):
+        # Length of every song's latent vector, by index, as closest reports
+        # alongside each similarity.
+        return self._normalized_latents()[1]
+
+    def song_mask(self, track_ids_echonest):
+        # Boolean mask over Y's rows of the given songs, such as the songs of
+        # a tag filter (see TagIndex.song_ids), to restrict searches to.
+        # Unknown ids are ignored.
+        idxs = self.song_id_map().get_idxs(track_ids_echonest)
+
+        mask = np.zeros(self.n, dtype=bool)
+        mask[idxs[idxs >= 0]] = True
+        return mask
+
+    def closest_batch(self, features, n=5, mask=None):
+        # For each row of features (a Q-by-f matrix), the Echo Nest ids,
+        # indices and cosine similarities of the n most similar songs, as
+        # Q-by-n arrays, best first, optionally only among the songs set in
+        # mask (see song_mask). Similarities are computed against a cached,
+        # normalized Y in chunks of queries of bounded size.
+        Y_normalized, _ = self._normalized_latents()
+        features        = np.atleast_2d(features)
+        features_norm   = np.linalg.norm(features, axis=1)
+        chunk_size      = ranking.chunk_rows(self.n)
+
+        n       = min(n, self.n if mask is None else int(mask.sum()))
+        idx     = np.empty((features.shape[0], n), dtype=np.int64)
+        score   = np.empty((features.shape[0], n), dtype=Y_normalized.dtype)
+
+        for start_ind in xrange(0, features.shape[0], chunk_size):
+            end_ind = min(start_ind + chunk_size, features.shape[0])
+
+            r = features[start_ind:end_ind].dot(Y_normalized.T)
+            r /= np.where(features_norm[start_ind:end_ind] > 0, features_norm[start_ind:end_ind], 1)[:, np.newaxis]
+            if mask is not None: r[:, ~mask] = -np.inf
+            idx[start_ind:end_ind], score[start_ind:end_ind] = ranking.top_k(r, n)
+
+        return self.song_id_map().get_ids(idx), idx, score
+
+    def hybrid_index(self):
+        # Index of the song vectors of Y merged with vectors inserted from
+        # other sources, such as latent_regression predictions for songs
+        # without plays. Loaded from the store, or seeded from Y.
+        if self._hybrid is None:
+            self._hybrid = hybrid.HybridIndex.load(GET_STORE_PATH('hybrid'))
+            if self._hybrid is None: self._hybrid = hybrid.HybridIndex(self.f)
+            self._hybrid.sync(self.song_id_map().ids, self.Y, source='cf')
+
+        return self._hybrid
+
+    def save_hybrid_index(self):
+        self.hybrid_index().save(GET_STORE_PATH('hybrid'))
+
+    def closest(self, features, n=5, ordered=False, approximate=False, nprobe=ann.NPROBE, mask=None):
+        # With approximate=True, candidates come from the IVF index, where
+        # nprobe trades recall for speed; similarities are still exact. With
+        # a mask (see song_mask), only the songs set in it are candidates.
+        Y_normalized, Y_norms = self._normalized_latents()
+
+        if approximate:
+            closest_idx, r_closest = self.ann_index().query(features, n, nprobe=nprobe, mask=mask)
+        else:
+            r = np.dot(Y_normalized, features) / np.linalg.norm(features)
+            if mask is not None:
+                r[~mask]    = -np.inf
+                n           = min(n, int(mask.sum()))
+            closest_idx = np.argpartition(r, -n)[-n:] if n else np.zeros(0, dtype=np.int64)
+            r_closest   = r[closest_idx]
+
+        r_closest = dict(zip(closest_idx, r_closest))
+
+        track_ids_echonest, idxs = self._get_track_ids(closest_idx)
         idxs = list(idxs)
-        results = zip(track_ids_echonest, r[idxs], song_norm[idxs])
+        results = zip(track_ids_echonest, [r_closest[idx] for idx in idxs], Y_norms[idxs])
 
         if ordered:
             results = sorted(results, key=lambda x: x[1], reverse=True)
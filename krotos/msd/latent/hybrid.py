@@ -0,0 +1,200 @@
+import numpy as np
+
+from krotos.utils import atomic_write
+from krotos.msd.latent import ranking
+from krotos.exceptions import ParametersError
+
+
+
+# A similarity index over song latent vectors from more than one source: the
+# collaborative filtering Y ('cf') and vectors predicted from audio by the
+# latent_regression network ('cnn') for songs without play data. Entries are
+# kept normalized in growable float32 buffers, so inserts and deletes touch
+# only their own rows and are searchable as soon as they return. Deleted rows
+# are masked until enough of them pile up to be worth compacting away.
+
+SOURCES = ('cf', 'cnn')
+
+ID_DTYPE = 'S18'
+
+INITIAL_CAPACITY = 1024
+
+# Compact once deleted rows make up this fraction of the buffers.
+COMPACT_FRACTION = 0.25
+
+
+
+class HybridIndex(object):
+    def __init__(self, f, capacity=INITIAL_CAPACITY):
+        self.f          = f
+        self.size       = 0
+
+        self._vectors   = np.empty((capacity, f), dtype=np.float32)
+        self._norms     = np.empty(capacity, dtype=np.float32)
+        self._sources   = np.empty(capacity, dtype=np.int8)
+        self._ids       = np.empty(capacity, dtype=ID_DTYPE)
+        self._alive     = np.zeros(capacity, dtype=bool)
+
+        # Row of each live id, and the ids deleted since they were last
+        # inserted, which sync() leaves out.
+        self._rows      = {}
+        self._deleted   = set()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, track_id_echonest):
+        return track_id_echonest in self._rows
+
+    def _source_code(self, source):
+        if source not in SOURCES:
+            raise ParametersError("Unknown vector source {}; expected one of {}.".format(source, SOURCES))
+        return SOURCES.index(source)
+
+    def _reserve(self, rows):
+        capacity = self._vectors.shape[0]
+        if self.size + rows <= capacity: return
+
+        while capacity < self.size + rows:
+            capacity *= 2
+
+        for name in ('_vectors', '_norms', '_sources', '_ids', '_alive'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def insert(self, track_ids_echonest, vectors, source='cnn', replace=True):
+        # Adds or replaces the vectors of songs by Echo Nest id. With
+        # replace=False, songs already in the index keep their vectors.
+        code    = self._source_code(source)
+        vectors = np.atleast_2d(vectors)
+
+        if vectors.shape != (len(track_ids_echonest), self.f):
+            raise ParametersError("Expected {} vectors of length {}.".format(len(track_ids_echonest), self.f))
+
+        track_ids_echonest  = np.asarray(track_ids_echonest, dtype=ID_DTYPE)
+        rows                = np.array([self._rows.get(track_id_echonest, -1) for track_id_echonest in track_ids_echonest], dtype=np.int64)
+        if not replace:
+            keep                = rows < 0
+            track_ids_echonest  = track_ids_echonest[keep]
+            vectors, rows       = vectors[keep], rows[keep]
+
+        # Unseen ids get rows at the end, shared by repeats within one call.
+        new                     = np.flatnonzero(rows < 0)
+        new_ids, new_inverse    = np.unique(track_ids_echonest[new], return_inverse=True)
+        new_rows                = np.arange(self.size, self.size + len(new_ids))
+
+        self._reserve(len(new_ids))
+        self._rows.update(zip(new_ids, new_rows))
+        self.size   += len(new_ids)
+        rows[new]   = new_rows[new_inverse]
+
+        norms = np.linalg.norm(vectors, axis=1)
+        self._vectors[rows] = vectors / np.where(norms > 0, norms, 1)[:, np.newaxis]
+        self._norms[rows]   = norms
+        self._sources[rows] = code
+        self._ids[rows]     = track_ids_echonest
+        self._alive[rows]   = True
+
+        self._deleted.difference_update(track_ids_echonest)
+
+    def sync(self, track_ids_echonest, vectors, source='cf'):
+        # Replaces the vectors of a source that is refreshed as a whole, such
+        # as Y after minimization, without bringing back deleted songs. Songs
+        # of that source missing from track_ids_echonest are dropped.
+        track_ids_echonest  = np.asarray(track_ids_echonest, dtype=ID_DTYPE)
+        stale               = np.flatnonzero(self._alive[:self.size] & (self._sources[:self.size] == self._source_code(source)))
+        stale               = stale[~np.in1d(self._ids[stale], track_ids_echonest)]
+
+        for row in stale:
+            del self._rows[self._ids[row]]
+        self._alive[stale] = False
+
+        keep = np.array([track_id_echonest not in self._deleted for track_id_echonest in track_ids_echonest], dtype=bool)
+        self.insert(track_ids_echonest[keep], np.atleast_2d(vectors)[keep], source=source)
+
+        if self.size - len(self) > COMPACT_FRACTION * self.size:
+            self._compact()
+
+    def delete(self, track_ids_echonest):
+        for track_id_echonest in track_ids_echonest:
+            row = self._rows.pop(track_id_echonest, None)
+            if row is not None: self._alive[row] = False
+            self._deleted.add(track_id_echonest)
+
+        if self.size - len(self) > COMPACT_FRACTION * self.size:
+            self._compact()
+
+    def _compact(self):
+        live = np.flatnonzero(self._alive[:self.size])
+
+        for name in ('_vectors', '_norms', '_sources', '_ids', '_alive'):
+            getattr(self, name)[:len(live)] = getattr(self, name)[live]
+
+        self._alive[len(live):self.size] = False
+        self.size = len(live)
+        self._rows = dict(zip(self._ids[:self.size], xrange(self.size)))
+
+    def get(self, track_id_echonest):
+        # The vector and source of a song, or (None, None).
+        row = self._rows.get(track_id_echonest)
+        if row is None: return None, None
+        return self._vectors[row] * self._norms[row], SOURCES[self._sources[row]]
+
+    def closest(self, features, n=5, sources=None, track_ids_echonest=None):
+        # For each row of features, the Echo Nest ids, sources and cosine
+        # similarities of the n most similar songs, best first, optionally
+        # only among songs from the given sources and among the given songs
+        # (e.g. TagIndex.song_ids of a tag filter).
+        features    = np.atleast_2d(features)
+        allowed     = self._alive[:self.size].copy()
+        if sources is not None:
+            allowed &= np.in1d(self._sources[:self.size], [self._source_code(source) for source in sources])
+        if track_ids_echonest is not None:
+            allowed &= np.in1d(self._ids[:self.size], np.asarray(track_ids_echonest, dtype=ID_DTYPE))
+
+        n           = min(n, int(allowed.sum()))
+        chunk_size  = ranking.chunk_rows(self.size)
+        idx         = np.empty((features.shape[0], n), dtype=np.int64)
+        score       = np.empty((features.shape[0], n), dtype=np.float32)
+
+        features_norm = np.linalg.norm(features, axis=1)
+        features_norm = np.where(features_norm > 0, features_norm, 1)
+
+        for start_ind in xrange(0, features.shape[0], chunk_size):
+            end_ind = min(start_ind + chunk_size, features.shape[0])
+
+            r = (features[start_ind:end_ind] / features_norm[start_ind:end_ind, np.newaxis]).astype(np.float32).dot(self._vectors[:self.size].T)
+            r[:, ~allowed] = -np.inf
+            idx[start_ind:end_ind], score[start_ind:end_ind] = ranking.top_k(r, n)
+
+        return self._ids[idx], np.array(SOURCES)[self._sources[idx]], score
+
+    def save(self, path):
+        self._compact()
+
+        with atomic_write(path) as tmp_path, open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                vectors=self._vectors[:self.size] * self._norms[:self.size, np.newaxis],
+                sources=self._sources[:self.size],
+                ids=self._ids[:self.size],
+                deleted=np.array(sorted(self._deleted), dtype=ID_DTYPE)
+            )
+
+    @classmethod
+    def load(cls, path):
+        # None if there is no index at path.
+        try:
+            obj = np.load(path)
+        except IOError:
+            return None
+
+        index = cls(obj['vectors'].shape[1], capacity=max(INITIAL_CAPACITY, len(obj['ids'])))
+        for code, source in enumerate(SOURCES):
+            rows = obj['sources'] == code
+            index.insert(obj['ids'][rows], obj['vectors'][rows], source=source)
+        index._deleted = set(obj['deleted'])
+
+        return index
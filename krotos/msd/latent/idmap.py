@@ -0,0 +1,111 @@
+import os
+import numpy as np
+
+from krotos.utils import atomic_write
+from krotos.debug import report
+
+
+
+# Bidirectional map between Echo Nest ids and 0-based indices, held in
+# compact NumPy arrays: the ids by index, and, unless they already are, the
+# ids in sorted order with the index of each. Ids are looked up with a
+# vectorized searchsorted and indices with a gather, so whole arrays of
+# either are resolved at once. Saved maps are memory-mapped on load.
+#
+# A map is saved as up to three .npy files starting with a common prefix.
+SUFFIXES = {
+    'ids':      '_ids.npy',
+    'sorted':   '_sorted.npy',
+    'order':    '_order.npy',
+}
+
+
+
+class IdMap(object):
+    def __init__(self, ids, sorted_ids=None, order=None):
+        # order: the indices that sort ids, or None if ids are sorted.
+        self.ids    = ids
+        self._order = order
+        self._sorted = ids if order is None else (sorted_ids if sorted_ids is not None else ids[order])
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_ids(cls, ids):
+        ids = np.asarray(ids)
+        if np.all(ids[1:] >= ids[:-1]): return cls(ids)
+
+        order = np.argsort(ids, kind='mergesort').astype(np.int32)
+        return cls(ids, order=order)
+
+    @classmethod
+    def load(cls, prefix):
+        # None if no map was saved with this prefix, or if an interrupted
+        # save left its files out of step.
+        path = lambda key: prefix + SUFFIXES[key]
+        if not os.path.exists(path('ids')): return None
+
+        ids = np.load(path('ids'), mmap_mode='r')
+        if not os.path.exists(path('order')): return cls(ids)
+
+        sorted_ids, order = np.load(path('sorted'), mmap_mode='r'), np.load(path('order'), mmap_mode='r')
+        if not len(sorted_ids) == len(order) == len(ids): return None
+
+        return cls(ids, sorted_ids, order)
+
+    @classmethod
+    def load_or_build(cls, prefix, ids, get_ids, rows):
+        # The map of a latent store's rows. Stores built from
+        # train_triplets.txt keep their ids as an array already (ids).
+        # Otherwise the map is read from SQLite (get_ids) once and saved
+        # under prefix, to be read again should the store have grown past
+        # the saved map's rows.
+        if ids is not None: return cls.from_ids(ids)
+
+        id_map = cls.load(prefix)
+        if id_map is None or len(id_map) != rows:
+            report("Writing the id map {}...".format(os.path.basename(prefix)))
+            id_map = cls.from_ids(get_ids())
+            id_map.save(prefix)
+
+        return id_map
+
+    def save(self, prefix):
+        # Every file is written atomically, the ids last. Stale sorted and
+        # order files are removed only after that. Ids are only ever appended
+        # to, so files left out of step by a crash differ in length, and
+        # load() rejects them.
+        path    = lambda key: prefix + SUFFIXES[key]
+        arrays  = {'ids': self.ids}
+        if self._order is not None:
+            arrays.update(sorted=self._sorted, order=self._order)
+
+        for key in ('sorted', 'order', 'ids'):
+            if key not in arrays: continue
+
+            with atomic_write(path(key)) as tmp_path, open(tmp_path, 'wb') as f:
+                np.save(f, arrays[key])
+
+        if self._order is None:
+            for key in ('sorted', 'order'):
+                if os.path.exists(path(key)): os.remove(path(key))
+
+    def get_idxs(self, ids):
+        # Index of each id, or -1 if it is unknown.
+        ids = np.asarray(ids)
+        if not len(self): return np.repeat(-1, len(ids))
+
+        pos     = np.minimum(np.searchsorted(self._sorted, ids), len(self) - 1)
+        found   = self._sorted[pos] == ids
+        idxs    = pos if self._order is None else self._order[pos]
+
+        return np.where(found, idxs, -1)
+
+    def get_idx(self, id_):
+        # Index of one id, or None if it is unknown.
+        idx = self.get_idxs([id_])[0]
+        return None if idx < 0 else idx
+
+    def get_ids(self, idxs):
+        return self.ids[np.asarray(idxs)]
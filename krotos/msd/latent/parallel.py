@@ -0,0 +1,112 @@
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+from scipy import sparse
+
+from krotos.msd.latent import als
+from krotos.debug import report
+
+
+
+# The matrix being updated, the fixed matrix, and the confidence matrix whose
+# rows index into the fixed matrix, for each half-step of minimization.
+OPERANDS = {
+    'X': ('X', 'Y', 'C_ui'),
+    'Y': ('Y', 'X', 'C_iu'),
+}
+
+# Number of shards handed out per worker and batch, so that workers that draw
+# light row ranges pick up more of them.
+SHARDS_PER_WORKER = 4
+
+# Arrays inherited by forked workers; see SharedUpdater.
+_SHARED = {}
+
+
+
+def shared_array(shape, dtype=np.float64):
+    # An ndarray backed by anonymous shared memory, visible to (and writable
+    # by) every process forked after its creation.
+    dtype   = np.dtype(dtype)
+    size    = int(np.prod(shape))
+    buf     = RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
+
+def to_shared(arr):
+    # Writable memory maps are already shared with forked processes.
+    if isinstance(arr, np.memmap): return arr
+
+    shared      = shared_array(arr.shape, arr.dtype)
+    shared[...] = arr
+    return shared
+
+def to_shared_csr(C):
+    return sparse.csr_matrix(
+        (to_shared(C.data), to_shared(C.indices), to_shared(C.indptr)),
+        shape=C.shape,
+        copy=False
+    )
+
+def shard_rows(indptr, start_ind, end_ind, shards):
+    # Split rows [start_ind, end_ind) into at most `shards` contiguous ranges
+    # of roughly equal confidence entry counts; the work of a row solve grows
+    # with its number of entries.
+    targets = np.linspace(indptr[start_ind], indptr[end_ind], shards + 1)[1:-1]
+    cuts    = np.searchsorted(indptr[start_ind:(end_ind + 1)], targets) + start_ind
+    bounds  = np.unique(np.concatenate(([start_ind], cuts, [end_ind])))
+    return zip(bounds[:-1], bounds[1:])
+
+def _initialize_worker(arrays):
+    _SHARED.clear()
+    _SHARED.update(arrays)
+
+def shared_pool(arrays, workers):
+    # A pool of forked workers that find `arrays` through shared(); the arrays
+    # should already live in shared memory or be read-only.
+    return Pool(workers, initializer=_initialize_worker, initargs=(arrays,))
+
+def shared(key):
+    return _SHARED[key]
+
+def _update_rows(task):
+    mtx, B_T_B_regularized, start_ind, end_ind, solver = task
+    A, B, C_ab = (shared(key) for key in OPERANDS[mtx])
+
+    als.solve_rows(A, B, C_ab, B_T_B_regularized, start_ind, end_ind, solver)
+
+    return end_ind - start_ind
+
+
+
+class SharedUpdater(object):
+    # Holds a pool of forked workers that solve row ranges of X or Y in place.
+    # The arrays must live in shared memory (see to_shared) before the pool is
+    # created; workers inherit them on fork, so nothing is pickled besides the
+    # f-by-f Gram matrix and the row range of each shard.
+
+    def __init__(self, arrays, workers):
+        self._arrays    = arrays
+        self._workers   = workers
+        self._pool      = shared_pool(arrays, workers)
+
+    def update_matrix(self, mtx, param_lambda, start_ind=0, end_ind=None, solver='block'):
+        A, B, C_ab  = (self._arrays[key] for key in OPERANDS[mtx])
+        rows        = A.shape[0]
+        end_ind     = min(end_ind or rows, rows)
+        batch_size  = end_ind - start_ind
+
+        B_T_B_regularized = als.regularized_gram(B, param_lambda)
+
+        tasks = [
+            (mtx, B_T_B_regularized, shard_start, shard_end, solver)
+            for shard_start, shard_end in shard_rows(C_ab.indptr, start_ind, end_ind, self._workers * SHARDS_PER_WORKER)
+        ]
+
+        done = 0
+        for shard_size in self._pool.imap_unordered(_update_rows, tasks):
+            done += shard_size
+            report("{0:7.3f}% of latent feature matrix updated... ({1:.3f}% of batch complete)".format((start_ind + done) * 100.0 / rows, done * 100.0 / batch_size), sameline=True)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,29 @@
+import numpy as np
+
+
+
+# Upper bound on the number of scores materialized at once by chunked scoring.
+CHUNK_ELEMENTS = 1 << 24
+
+def chunk_rows(n_cols, max_elements=CHUNK_ELEMENTS):
+    # Number of query rows that can be scored against n_cols candidates at once.
+    return max(1, max_elements // max(n_cols, 1))
+
+def mask(scores, exclude):
+    # Sets the entries of a chunk of scores that are stored in the sparse
+    # matrix `exclude` (one row per scored row) to -inf.
+    exclude = exclude.tocoo()
+    scores[exclude.row, exclude.col] = -np.inf
+    return scores
+
+def top_k(scores, k):
+    # Indices and values of the k highest scores of each row, best first.
+    k = min(k, scores.shape[1])
+    if k == 0: return np.zeros((scores.shape[0], 0), dtype=np.intp), np.zeros((scores.shape[0], 0), dtype=scores.dtype)
+
+    rows    = np.arange(scores.shape[0])[:, np.newaxis]
+    idx     = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order   = np.argsort(-scores[rows, idx], axis=1)
+    idx     = idx[rows, order]
+
+    return idx, scores[rows, idx]
@@ -0,0 +1,70 @@
+import numpy as np
+from multiprocessing import cpu_count
+
+from krotos.utils import atomic_write
+from krotos.msd.latent import parallel, ranking
+from krotos.debug import report
+
+
+
+RECOMMENDATIONS = 500
+
+
+
+def _recommend_users(task):
+    start_ind, end_ind = task
+    X, Y, C_ui = (parallel.shared(key) for key in ('X', 'Y', 'C_ui'))
+
+    scores      = ranking.mask(X[start_ind:end_ind].dot(Y.T), C_ui[start_ind:end_ind])
+    idx, score  = ranking.top_k(scores, parallel.shared('recs')['idx'].shape[1])
+
+    # Users who played nearly every song run out of candidates.
+    idx[np.isneginf(score)] = -1
+
+    parallel.shared('recs')['idx'][start_ind:end_ind]     = idx
+    parallel.shared('recs')['score'][start_ind:end_ind]   = score
+
+    return end_ind - start_ind
+
+def _dtype(n):
+    # One record per user: the song indices and their scores side by side, so
+    # both live in (and are replaced with) a single file.
+    return np.dtype([('idx', np.int32, (n,)), ('score', np.float32, (n,))])
+
+def recommend_all(X, Y, C_ui, path, n=RECOMMENDATIONS, workers=None):
+    # Writes the n best scoring songs not yet played by each user, best first,
+    # to a memory-mapped .npy file of m records holding the song indices
+    # (int32, -1 where a user has fewer than n unplayed songs) and their
+    # scores (float32). Users are scored in memory-bounded chunks of X Y^T
+    # across a pool of forked workers, which write their rows of the output
+    # in place. The file is written under a temporary name and moved into
+    # place once complete, so an interrupted run leaves the previous
+    # recommendations intact.
+    m, n        = X.shape[0], min(n, Y.shape[0])
+    chunk_size  = ranking.chunk_rows(Y.shape[0])
+    tasks       = [(start_ind, min(start_ind + chunk_size, m)) for start_ind in xrange(0, m, chunk_size)]
+
+    with atomic_write(path) as tmp_path:
+        recs    = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=_dtype(n), shape=(m,))
+        pool    = parallel.shared_pool({'X': X, 'Y': Y, 'C_ui': C_ui, 'recs': recs}, workers or cpu_count())
+
+        done = 0
+        try:
+            for rows in pool.imap_unordered(_recommend_users, tasks):
+                done += rows
+                report("{0:7.3f}% of users' recommendations written...".format(done * 100.0 / m), sameline=True)
+        finally:
+            pool.close()
+            pool.join()
+
+        report('')
+
+        recs.flush()
+        del recs
+
+    return load(path)
+
+def load(path):
+    # The m-by-n song indices and scores, as views of one memory map.
+    recs = np.load(path, mmap_mode='r')
+    return recs['idx'], recs['score']
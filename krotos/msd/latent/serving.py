@@ -0,0 +1,44 @@
+import numpy as np
+
+from krotos.utils import Singleton
+from krotos.msd.db.echonest import EchoNestTasteDB
+from krotos.msd.latent import features, idmap
+from krotos.exceptions import ParametersError
+
+
+
+# Read-only access to the song latent vectors of a trained store, for
+# processes that only look songs up. Only Y and a sorted id-to-index map are
+# opened, both memory-mapped read-only, so startup does no real I/O and the
+# pages are shared through the page cache by every process reading the
+# store, including forked workers. Nothing here touches X, the confidence
+# matrix or (once the map exists) SQLite.
+
+
+
+class LatentServing(object):
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        path = features.GET_STORE_PATH
+
+        self.Y = features.LatentFeatures._load(path('Y'), mode='memmap_readonly')
+        if self.Y is None: raise ParametersError("No latent feature store to serve; minimize one first.")
+
+        self._load_lookup()
+
+    def _load_lookup(self):
+        songs       = features.LatentFeatures._load(features.GET_STORE_PATH('songs'), mode='memmap_readonly')
+        get_ids     = lambda: EchoNestTasteDB(subset=features.SUBSET).get_song_ids()
+        self.id_map = idmap.IdMap.load_or_build(features.GET_STORE_PATH('song_map'), songs, get_ids, self.Y.shape[0])
+
+    def get_idxs(self, track_ids_echonest):
+        # Index into Y of each Echo Nest song id, or -1 if it is unknown.
+        return self.id_map.get_idxs(track_ids_echonest)
+
+    def get(self, track_id_echonest):
+        # Same as LatentFeatures.get: the song's latent vector and index, or
+        # (None, None).
+        idx = self.id_map.get_idx(track_id_echonest)
+        if idx is None: return None, None
+        return np.array(self.Y[idx, :]), idx
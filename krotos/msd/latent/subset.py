@@ -0,0 +1,61 @@
+import numpy as np
+
+from krotos.msd.latent import triplets
+from krotos.debug import report
+
+
+
+# Builds the subset store (loaded with features.SUBSET = True) from the full
+# play count matrix in memory, in place of the SQL in echonest_notes.md. As
+# there, songs are ranked by their number of distinct listeners rather than
+# by plays. Users are then sampled with a fixed seed, so the same arguments
+# always give the same subset.
+
+N_SONGS = 10000
+N_USERS = 20000
+
+
+
+def load_full():
+    # The full play count matrix with its user and song ids, from a store
+    # built from train_triplets.txt or else from SQLite.
+    return triplets.load_store(subset=False)
+
+def select(R, n_songs=N_SONGS, n_users=N_USERS, min_user_songs=1, min_song_listeners=1, seed=0):
+    # Indices of the kept users and songs of the user-by-song matrix R: the
+    # n_songs songs with the most listeners, then a seeded sample of n_users
+    # users among those with at least min_user_songs of the kept songs. Songs
+    # left with fewer than min_song_listeners sampled users are dropped.
+    R = R.tocsr()
+
+    listeners   = np.bincount(R.indices, minlength=R.shape[1])
+    kept_songs  = np.sort(np.argsort(-listeners, kind='mergesort')[:n_songs])
+
+    R_songs     = R[:, kept_songs]
+    eligible    = np.flatnonzero(np.diff(R_songs.indptr) >= min_user_songs)
+    random      = np.random.RandomState(seed)
+    kept_users  = np.sort(random.choice(eligible, min(n_users, len(eligible)), replace=False))
+
+    listeners   = np.bincount(R_songs[kept_users].indices, minlength=len(kept_songs))
+    kept_songs  = kept_songs[listeners >= min_song_listeners]
+
+    return kept_users, kept_songs
+
+def build(n_songs=N_SONGS, n_users=N_USERS, min_user_songs=1, min_song_listeners=1, seed=0, source=None):
+    # Writes the subset store. `source` is an optional (R, users, songs) of
+    # the full data, which is otherwise loaded with load_full.
+    R, users, songs = source or load_full()
+
+    kept_users, kept_songs = select(R, n_songs, n_users, min_user_songs, min_song_listeners, seed)
+
+    # Index the subset in sorted id order, as LatentFeatures expects of
+    # stores with id arrays.
+    kept_users = kept_users[np.argsort(users[kept_users], kind='mergesort')]
+    kept_songs = kept_songs[np.argsort(songs[kept_songs], kind='mergesort')]
+
+    R_subset = R[kept_users][:, kept_songs].tocsr()
+    report("Subset has {} plays by {} users of {} songs.".format(R_subset.nnz, len(kept_users), len(kept_songs)))
+
+    triplets.write_store(R_subset, users[kept_users], songs[kept_songs], subset=True)
+
+    return R_subset, users[kept_users], songs[kept_songs]
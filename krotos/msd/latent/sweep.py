@@ -0,0 +1,107 @@
+import os
+import itertools
+import pickle
+import time
+import numpy as np
+from multiprocessing import cpu_count
+
+from krotos.paths import PATHS
+from krotos.msd.latent import evaluation, features, parallel, triplets
+from krotos.debug import report
+
+
+
+SWEEP_DIR = os.path.join(PATHS['msd_echonest_latent'], 'sweep')
+
+
+
+def grid(**axes):
+    # Every combination of the given hyperparameter values, e.g.
+    # grid(param_lambda=[0.1, 1.0], param_alpha=[1.0, 2.0]). Hyperparameters
+    # that are left out take the values in krotos.msd.latent.features.
+    defaults = {
+        'param_lambda':     features.LAMBDA,
+        'param_alpha':      features.ALPHA,
+        'param_epsilon':    features.EPSILON,
+        'f':                features.LATENT_FEATURES,
+    }
+
+    names = sorted(axes)
+    for values in itertools.product(*(axes[name] for name in names)):
+        trial = defaults.copy()
+        trial.update(zip(names, values))
+        yield trial
+
+def load_plays(subset=None):
+    # The raw user-by-song play count matrix, read once per sweep from the
+    # store's own play counts if it has them, or else from SQLite.
+    return triplets.load_store(subset=subset)[0]
+
+def _sweep_dir():
+    # A new directory under SWEEP_DIR for each sweep, named by its start time
+    # and process id, so trials of earlier sweeps are never mixed in.
+    path = os.path.join(SWEEP_DIR, '{}_{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    os.makedirs(path)
+    return path
+
+def _trial_dir(sweep_dir, trial_ind):
+    path = os.path.join(sweep_dir, 'trial_{:03d}'.format(trial_ind))
+    if not os.path.isdir(path): os.makedirs(path)
+    return path
+
+def _run_trial(task):
+    sweep_dir, trial_ind, trial, rounds, solver, k, seed = task
+    train, test = parallel.shared('train'), parallel.shared('test')
+
+    X, Y    = evaluation.fit(train, rounds=rounds, solver=solver, seed=seed, **trial)
+    metrics = evaluation.evaluate(X, Y, train, test, k=k, workers=1)
+
+    path = _trial_dir(sweep_dir, trial_ind)
+    np.save(os.path.join(path, 'X.npy'), X)
+    np.save(os.path.join(path, 'Y.npy'), Y)
+    with open(os.path.join(path, 'trial.pickle'), 'wb') as f:
+        pickle.dump({'trial': trial, 'rounds': rounds, 'solver': solver, 'metrics': metrics}, f)
+
+    return trial_ind, trial, metrics
+
+def sweep(trials, R=None, rounds=10, solver='block', holdout=0.2, k=evaluation.MAP_K, metric=None, workers=None, seed=0):
+    # Trains one set of latent factors per trial on the same training split of
+    # the play matrix R (from load_plays if not given) and ranks the trials by
+    # a held out metric, MAP@k by default. Trials run in parallel worker
+    # processes that share the split play matrices; each trial's X, Y and
+    # metrics are written to its own directory under a new directory of
+    # SWEEP_DIR for this sweep.
+    trials = list(trials)
+    metric = metric or 'map@{}'.format(k)
+
+    # An empty grid has nothing to train, and no pool of zero workers.
+    if not trials: return []
+
+    if R is None: R = load_plays()
+    train, test = evaluation.holdout(R, fraction=holdout, seed=seed)
+    del R
+
+    arrays = {'train': parallel.to_shared_csr(train), 'test': parallel.to_shared_csr(test)}
+    del train, test
+
+    sweep_dir   = _sweep_dir()
+    tasks       = [(sweep_dir, trial_ind, trial, rounds, solver, k, seed) for trial_ind, trial in enumerate(trials)]
+    report("Writing trials to {}...".format(sweep_dir))
+
+    pool    = parallel.shared_pool(arrays, min(workers or cpu_count(), len(tasks)))
+    results = []
+
+    try:
+        for trial_ind, trial, metrics in pool.imap_unordered(_run_trial, tasks):
+            results.append((trial_ind, trial, metrics))
+            report("Trial {0} of {1} done: {2} = {3:.5f}.".format(len(results), len(tasks), metric, metrics[metric]))
+    finally:
+        pool.close()
+        pool.join()
+
+    results.sort(key=lambda result: result[2][metric], reverse=True)
+
+    for trial_ind, trial, metrics in results:
+        report("{0:.5f}\ttrial_{1:03d}\t{2}".format(metrics[metric], trial_ind, ', '.join('{}={}'.format(name, trial[name]) for name in sorted(trial))))
+
+    return results
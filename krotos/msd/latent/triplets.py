@@ -0,0 +1,133 @@
+import os
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from scipy import sparse
+
+from krotos.paths import PATHS
+from krotos.msd.db.echonest import EchoNestTasteDB
+from krotos.msd.latent import features
+from krotos.exceptions import ParametersError
+from krotos.debug import report
+
+
+
+# Builds the latent feature store straight from the Echo Nest Taste Profile
+# dump (train_triplets.txt, lines of "user\tsong\tcount"), without the SQLite
+# import described in echonest_notes.md. Users and songs are indexed in the
+# sorted order of their ids, which the store records in users.npy and
+# songs.npy in place of the vector_users and vector_songs tables.
+# LatentFeatures.refresh appends the ids of new users and songs after them.
+
+CHUNK_BYTES = 1 << 26
+
+USER_DTYPE  = 'S40'
+SONG_DTYPE  = 'S18'
+
+
+
+def _chunk_bounds(path, chunk_bytes):
+    # Byte ranges of the file of about chunk_bytes each, cut at line ends.
+    size    = os.path.getsize(path)
+    bounds  = [0]
+
+    with open(path, 'rb') as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_bytes, size))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+
+    return zip(bounds[:-1], bounds[1:])
+
+def _parse_chunk(task):
+    # Parses one byte range into its distinct users and songs, and the index
+    # of each line's user and song among them, which keeps what is sent back
+    # to the parent small.
+    path, start, end = task
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+
+    user, song, count = zip(*(line.split('\t') for line in lines if line))
+
+    users, user_inverse = np.unique(np.array(user, dtype=USER_DTYPE), return_inverse=True)
+    songs, song_inverse = np.unique(np.array(song, dtype=SONG_DTYPE), return_inverse=True)
+
+    return users, user_inverse.astype(np.int32), songs, song_inverse.astype(np.int32), np.array(count, dtype=np.float32)
+
+def read_triplets(path=None, workers=None, chunk_bytes=CHUNK_BYTES):
+    # Returns the user-by-song play count matrix (CSR) with the user and song
+    # ids of its rows and columns.
+    path    = path or PATHS['msd_echonest_triplets']
+    tasks   = [(path, start, end) for start, end in _chunk_bounds(path, chunk_bytes)]
+
+    pool = Pool(workers or cpu_count())
+    try:
+        chunks = []
+        for chunk in pool.imap(_parse_chunk, tasks):
+            chunks.append(chunk)
+            report("{0:7.3f}% of triplets parsed...".format(len(chunks) * 100.0 / len(tasks)), sameline=True)
+    finally:
+        pool.close()
+        pool.join()
+
+    report('')
+
+    users = np.unique(np.concatenate([chunk[0] for chunk in chunks]))
+    songs = np.unique(np.concatenate([chunk[2] for chunk in chunks]))
+
+    # Map each chunk's local indices to indices among all users and songs.
+    user = np.concatenate([np.searchsorted(users, chunk[0]).astype(np.int32)[chunk[1]] for chunk in chunks])
+    song = np.concatenate([np.searchsorted(songs, chunk[2]).astype(np.int32)[chunk[3]] for chunk in chunks])
+    count = np.concatenate([chunk[4] for chunk in chunks])
+    del chunks
+
+    R = sparse.coo_matrix((count, (user, song)), shape=(len(users), len(songs))).tocsr()
+
+    return R, users, songs
+
+def write_store(R, users, songs, subset=None):
+    # Writes the shape, play count matrix and id arrays of a latent feature
+    # store, the subset store if `subset` (or else features.SUBSET) is set.
+    # LatentFeatures then builds its confidence matrix from the play counts.
+    path = lambda key: features.GET_STORE_PATH(key, subset=subset)
+
+    # Matrices and indexes derived from other play counts would no longer
+    # line up.
+    stale = [key for key in ('C', 'X', 'Y', 'progress', 'history', 'ann', 'hybrid', 'recommendations') if os.path.exists(path(key))]
+    if stale:
+        raise ParametersError("Store already holds {}; move them away before rebuilding.".format(', '.join(stale)))
+
+    save = features.LatentFeatures._save
+    save(path('R'), R, mode='CSR')
+    save(path('users'), users, mode='ndarray')
+    save(path('songs'), songs, mode='ndarray')
+    save(path('shape'), R.shape)
+
+def load_store(subset=None):
+    # The play count matrix and id arrays written by write_store, or else
+    # read from SQLite for stores without them. The SQLite database is only
+    # opened, and so created if missing, when it holds the plays.
+    path = lambda key: features.GET_STORE_PATH(key, subset=subset)
+    load = features.LatentFeatures._load
+
+    R = load(path('R'), mode='sparse')
+    if R is not None:
+        return R.tocsr(), load(path('users'), mode='ndarray'), load(path('songs'), mode='ndarray')
+
+    if not os.path.exists(PATHS['msd_echonest_db']):
+        raise IOError("Neither {} nor the Echo Nest database {} exists.".format(path('R'), PATHS['msd_echonest_db']))
+
+    echonest            = EchoNestTasteDB(subset=features.SUBSET if subset is None else subset)
+    users, songs        = echonest.get_user_ids(), echonest.get_song_ids()
+    user, song, count   = echonest.get_all_playcounts()
+
+    return sparse.csr_matrix((count, (user, song)), shape=(len(users), len(songs))), users, songs
+
+def build(path=None, workers=None, subset=None):
+    R, users, songs = read_triplets(path, workers)
+    report("Read {} plays by {} users of {} songs.".format(R.nnz, len(users), len(songs)))
+
+    write_store(R, users, songs, subset=subset)
+
+    return R, users, songs
@@ -14,7 +14,7 @@ WORKERS = 1
 
 
 
-def make_minibatch(dataset, n=10, mapping='both', trim=False, normalize=False, audio_tempfile=False):
+def make_minibatch(dataset, n=10, mapping='both', trim=False, normalize=False, audio_tempfile=False, tag_filter=None):
     remainder   = n
     results     = []
 
@@ -26,7 +26,7 @@ def make_minibatch(dataset, n=10, mapping='both', trim=False, normalize=False, a
     # Workers should never be processing tracks such that more than
     # n tracks are downloaded from 7digital. We must conserve our API calls.
     while remainder > 0:
-        samples = select_samples(dataset, remainder, mapping, normalize, audio_tempfile)
+        samples = select_samples(dataset, remainder, mapping, normalize, audio_tempfile, tag_filter)
 
         for success, result in pool.map(process_sample, samples):
             if success:
@@ -49,41 +49,48 @@ def make_minibatch(dataset, n=10, mapping='both', trim=False, normalize=False, a
 
     return results
 
-def select_samples(dataset, n, mapping='both', normalize=False, audio_tempfile=False):
+def select_samples(dataset, n, mapping='both', normalize=False, audio_tempfile=False, tag_filter=None):
     samples = []
 
-    # Get metadata and Last.fm tags for a track.
-    # Do sqlite database accesses single-threaded.
+    # Draw the candidates still needed, and gather their metadata and Last.fm
+    # tags at once. Candidates without labels are dropped and redrawn.
     while len(samples) < n:
-        sample_ind          = dataset._sample_training_ind()
-        track_id, metadata  = msd_hdf5.get_summary([sample_ind])
+        sample_inds = dataset._sample_training_inds(n - len(samples), tag_filter)
+        metadata    = msd_hdf5.get_metadata(sample_inds)
 
-        track_id                                                    = track_id[0]
-        track_id_7digital, track_id_echonest, title, artist_name    = metadata[0]
-
-        if not track_id_7digital: continue
-
-        latent_features = None
-        if (mapping == 'both') or (mapping == 'latent_features'):
-            latent_features = latent.get_latent_features(track_id_echonest, normalize)
-            if latent_features is None: continue
-
-        tag_vector  = None
-        num_tags    = 0
         if (mapping == 'both') or (mapping == 'tag_vector'):
-            tag_vector, num_tags = lastfm.get_tag_vector(track_id)
-            if not num_tags: continue
-
-        samples.append({
-            'track_id':             track_id,
-            'track_id_7digital':    track_id_7digital,
-            'track_id_echonest':    track_id_echonest,
-            'title':                title,
-            'artist_name':          artist_name,
-            'latent_features':      latent_features,
-            'tag_vector':           tag_vector,
-            'tempfile':             audio_tempfile,
-        })
+            tag_vectors, tag_counts = lastfm.get_tag_vectors(sample_inds)
+
+        for i in xrange(len(sample_inds)):
+            track_id            = metadata['track_id'][i]
+            track_id_7digital   = metadata['track_7digitalid'][i]
+            track_id_echonest   = metadata['song_id'][i]
+            title               = metadata['title'][i]
+            artist_name         = metadata['artist_name'][i]
+
+            if not track_id_7digital: continue
+
+            latent_features = None
+            if (mapping == 'both') or (mapping == 'latent_features'):
+                latent_features = latent.get_latent_features(track_id_echonest, normalize)
+                if latent_features is None: continue
+
+            tag_vector  = None
+            num_tags    = 0
+            if (mapping == 'both') or (mapping == 'tag_vector'):
+                tag_vector, num_tags = tag_vectors[i], tag_counts[i]
+                if not num_tags: continue
+
+            samples.append({
+                'track_id':             track_id,
+                'track_id_7digital':    track_id_7digital,
+                'track_id_echonest':    track_id_echonest,
+                'title':                title,
+                'artist_name':          artist_name,
+                'latent_features':      latent_features,
+                'tag_vector':           tag_vector,
+                'tempfile':             audio_tempfile,
+            })
 
     return samples
 
@@ -1,9 +1,14 @@
 from krotos.msd.db import LastFMTagsDB
+from krotos.msd.utils.tag_matrix import TagMatrix
 
 
 
 def get_tag_vector(track_id):
     return LastFMTagsDB().get_tag_data(track_id)
 
+def get_tag_vectors(inds):
+    # Tag vectors and tag counts of tracks by MSD summary index.
+    return TagMatrix().get_tag_data(inds)
+
 def get_tag_names(tag_vector):
     return LastFMTagsDB().get_tag_names(tag_vector)
@@ -1,13 +1,28 @@
 import numpy as np
 
-from krotos.msd.latent.features import LatentFeatures
+from krotos.utils import LRUCache
+from krotos.msd.latent.serving import LatentServing
 
 
 
-def get_latent_features(track_id_echonest, normalize=False):
-    lf = LatentFeatures().get(track_id_echonest)[0]
+CACHE_SIZE = 100000
+
+CACHE = LRUCache(CACHE_SIZE)
+
+
+
+def _get_latent_features(track_id_echonest, normalize):
+    lf = LatentServing().get(track_id_echonest)[0]
     if lf is None: return None
     if normalize:
         norm = np.linalg.norm(lf)
         if norm != 0: lf = lf / norm
+
+    # Every caller gets the same cached array, so none may modify it.
+    lf.flags.writeable = False
     return lf
+
+def get_latent_features(track_id_echonest, normalize=False):
+    # Cached, including tracks without latent features. The arrays are
+    # read-only; copy one to modify it.
+    return CACHE.get((track_id_echonest, bool(normalize)), lambda: _get_latent_features(track_id_echonest, normalize))
@@ -1,19 +1,110 @@
+import os
 import h5py
 import numpy as np
 
-from krotos.paths import PATHS
+from krotos.paths import PATHS, mkdir_path
+from krotos.utils import atomic_write
 from krotos.debug import report
 
 
 
 SUMMARY_HANDLE = h5py.File(PATHS['msd_summary_h5'], 'r')
 
+# The summary fields used for sampling, by the group of the summary holding
+# them. get_columns keeps each as a fixed-width .npy array, memory-mapped, so
+# that metadata for many tracks is one gather per field rather than reads of
+# whole compound rows from two HDF5 datasets. With USE_COLUMNS = False the
+# columns are neither written nor read, and the fields come straight from
+# the summary.
+USE_COLUMNS = True
+
+COLUMNS = [
+    ('analysis', 'track_id'),
+    ('metadata', 'track_7digitalid'),
+    ('metadata', 'song_id'),
+    ('metadata', 'title'),
+    ('metadata', 'artist_name'),
+]
+METADATA_FIELDS = ['track_7digitalid', 'song_id', 'title', 'artist_name']
+GROUPS = dict((field, group) for group, field in COLUMNS)
+
+# Rows read from the summary at a time while building the columns.
+BUILD_ROWS = 100000
+
+mkdir_path('msd_summary_columns')
+GET_COLUMN_PATH = lambda field: os.path.join(PATHS['msd_summary_columns'], field + '.npy')
+
+_columns = None
+
+
+
 # inds must be sorted for the HDF5 reader
 def get_summary(inds):
     track_id = SUMMARY_HANDLE['analysis']['songs'][inds]['track_id']
-    metadata = SUMMARY_HANDLE['metadata']['songs'][inds][['track_7digitalid', 'song_id', 'title', 'artist_name']]
+    metadata = SUMMARY_HANDLE['metadata']['songs'][inds][METADATA_FIELDS]
 
     return track_id, metadata
 
+def get_summary_bulk(inds):
+    # Same as get_summary, for indices in any order and with repeats, in one
+    # read per dataset.
+    unique_inds, inverse = np.unique(inds, return_inverse=True)
+    track_id, metadata = get_summary(list(unique_inds))
+
+    return track_id[inverse], metadata[inverse]
+
+def get_column(field):
+    # One of the COLUMNS fields for every track, by summary index.
+    if USE_COLUMNS: return get_columns()[field]
+    return SUMMARY_HANDLE[GROUPS[field]]['songs'][field]
+
+def get_track_ids():
+    # Every track id, by summary index.
+    return get_column('track_id')
+
+def get_song_ids():
+    # Every Echo Nest song id, by summary index.
+    return get_column('song_id')
+
+def _build_columns():
+    report("Writing the summary columns...")
+    n = sample_size()
+
+    for group, field in COLUMNS:
+        dataset = SUMMARY_HANDLE[group]['songs']
+
+        with atomic_write(GET_COLUMN_PATH(field)) as tmp_path:
+            column = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dataset.dtype[field], shape=(n,))
+
+            for start_ind in xrange(0, n, BUILD_ROWS):
+                end_ind = min(start_ind + BUILD_ROWS, n)
+                column[start_ind:end_ind] = dataset[start_ind:end_ind][field]
+
+            column.flush()
+            del column
+
+def get_columns():
+    # The summary fields of COLUMNS by name, memory-mapped and built on first
+    # use.
+    global _columns
+
+    if _columns is None:
+        if not all(os.path.exists(GET_COLUMN_PATH(field)) for _, field in COLUMNS):
+            _build_columns()
+        _columns = dict((field, np.load(GET_COLUMN_PATH(field), mmap_mode='r')) for _, field in COLUMNS)
+
+    return _columns
+
+def get_metadata(inds):
+    # The summary fields of COLUMNS for each index, in any order, as arrays
+    # by field name.
+    inds = np.asarray(inds)
+    if USE_COLUMNS: return dict((field, column[inds]) for field, column in get_columns().iteritems())
+
+    track_id, metadata  = get_summary_bulk(inds)
+    result              = dict((field, metadata[field]) for field in METADATA_FIELDS)
+    result['track_id']  = track_id
+    return result
+
 def sample_size():
     return SUMMARY_HANDLE['analysis']['songs'].size
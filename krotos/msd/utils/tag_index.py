@@ -0,0 +1,129 @@
+import os
+import numpy as np
+
+from krotos.paths import PATHS
+from krotos.utils import Singleton, atomic_write
+from krotos.msd.db import LastFMTagsDB
+from krotos.msd.utils import msd_hdf5
+from krotos.msd.utils.tag_matrix import TagMatrix
+from krotos.debug import report
+
+
+
+# Inverted index from each of the N_TAGS subset tags to a bitmap of the MSD
+# summary indices of the tracks carrying it, built once from the TagMatrix. A
+# bitmap is a packed uint8 array of one bit per track (about 125KB over the
+# full summary), so AND/OR/NOT are single vectorized passes; on disk the
+# bitmaps are stored compressed.
+#
+#   index   = TagIndex()
+#   jazz    = index.query(all_of=['jazz'], none_of=['vocal'])
+#   inds    = index.select(candidate_inds, jazz)
+#
+# Latent features are indexed by Echo Nest song rather than by track, so
+# similarity searches are filtered by the songs of a bitmap's tracks:
+#
+#   songs   = index.song_ids(jazz)
+#   lf.closest_batch(features, mask=lf.song_mask(songs))
+
+
+
+class TagIndex(object):
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        self._tags = LastFMTagsDB()
+
+        # Subset tag ids and names, in the tag vector order.
+        self.tag_ids    = self._tags._tag_subset_ids
+        self.tag_names  = [row[1] for row in self._tags._tag_subset]
+        self._tag_rows  = dict(zip(self.tag_names, xrange(len(self.tag_names))))
+        self._tag_rows.update(zip(self.tag_ids, xrange(len(self.tag_ids))))
+
+        if not self._load():
+            self._build()
+            self._save()
+
+        # Every valid bit set, to keep NOT from setting the padding bits.
+        self._all = np.packbits(np.ones(self.n, dtype=bool))
+
+    def _load(self):
+        if not os.path.exists(PATHS['tag_index']): return False
+
+        with open(PATHS['tag_index'], 'rb') as f:
+            obj = np.load(f)
+            if not np.array_equal(obj['tag_ids'], self.tag_ids): return False
+
+            self.n          = int(obj['n'])
+            self.bitmaps    = obj['bitmaps']
+
+        return True
+
+    def _save(self):
+        with atomic_write(PATHS['tag_index']) as tmp_path, open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, tag_ids=self.tag_ids, n=self.n, bitmaps=self.bitmaps)
+
+    def _build(self):
+        report("Building the Last.fm tag index...")
+
+        R = TagMatrix().to_csc()
+
+        self.n          = R.shape[0]
+        self.bitmaps    = np.empty((R.shape[1], (self.n + 7) // 8), dtype=np.uint8)
+
+        for col in xrange(R.shape[1]):
+            bits = np.zeros(self.n, dtype=bool)
+            bits[R.indices[R.indptr[col]:R.indptr[col + 1]]] = True
+            self.bitmaps[col] = np.packbits(bits)
+
+    def bitmap(self, tag):
+        # The tracks carrying a subset tag, given by name or tag id.
+        return self.bitmaps[self._tag_rows[tag]]
+
+    def query(self, all_of=(), any_of=(), none_of=()):
+        # The tracks carrying every tag of all_of, at least one tag of any_of
+        # (if given) and none of the tags of none_of.
+        result = self._all.copy()
+
+        for tag in all_of:
+            np.bitwise_and(result, self.bitmap(tag), out=result)
+
+        if any_of:
+            np.bitwise_and(result, self.union(any_of), out=result)
+
+        if none_of:
+            np.bitwise_and(result, np.invert(self.union(none_of)), out=result)
+
+        return result
+
+    def union(self, tags):
+        result = np.zeros_like(self._all)
+        for tag in tags:
+            np.bitwise_or(result, self.bitmap(tag), out=result)
+        return result
+
+    def negate(self, bitmap):
+        return np.bitwise_and(np.invert(bitmap), self._all)
+
+    def count(self, bitmap):
+        return int(np.unpackbits(bitmap).sum())
+
+    def indices(self, bitmap):
+        # Sorted summary indices of the tracks in a bitmap.
+        return np.flatnonzero(np.unpackbits(bitmap)[:self.n])
+
+    def contains(self, bitmap, inds):
+        # Whether each summary index is in a bitmap.
+        inds = np.asarray(inds)
+        return ((bitmap[inds >> 3] >> (7 - (inds & 7))) & 1).astype(bool)
+
+    def song_ids(self, bitmap):
+        # Sorted Echo Nest ids of the songs with a track in a bitmap, through
+        # the summary's song id of each track.
+        return np.unique(msd_hdf5.get_song_ids()[self.indices(bitmap)])
+
+    def select(self, inds, bitmap):
+        # The summary indices among inds that are in a bitmap, for
+        # pre-filtering candidates or sample pools.
+        inds = np.asarray(inds)
+        return inds[self.contains(bitmap, inds)]
@@ -0,0 +1,100 @@
+import os
+import numpy as np
+from scipy import sparse
+
+from krotos.paths import PATHS, mkdir_path
+from krotos.utils import Singleton, atomic_write
+from krotos.msd.db import LastFMTagsDB
+from krotos.msd.utils import msd_hdf5
+from krotos.debug import report
+
+
+
+# The tid_tag table restricted to the N_TAGS subset tags, exported once as a
+# binary track-by-tag CSR matrix whose rows are MSD summary indices and
+# whose columns follow the tag vector order. Its index arrays are kept as
+# .npy files and memory-mapped on load, so tag vectors for any set of tracks
+# come from one gather over the rows instead of a SQL query per track.
+
+mkdir_path('tag_matrix')
+FILES = {
+    'indptr':   'indptr.npy',
+    'indices':  'indices.npy',
+    'tag_ids':  'tag_ids.npy',
+}
+GET_PATH = lambda x: os.path.join(PATHS['tag_matrix'], FILES[x])
+
+
+
+def summary_taggings(tags):
+    # Summary index and subset tag column of every subset tagging of a track
+    # in the summary, and the number of tracks in the summary. tids ROWIDs
+    # are matched to summary indices through the track ids.
+    summary_ids = msd_hdf5.get_track_ids()
+    order       = np.argsort(summary_ids)
+    tids        = tags.get_tids()
+    pos         = np.minimum(np.searchsorted(summary_ids, tids, sorter=order), len(order) - 1)
+    tid_inds    = np.where(summary_ids[order[pos]] == tids, order[pos], -1)
+
+    tid_rows, tag_ids   = tags.get_subset_taggings()
+    inds                = tid_inds[tid_rows]
+    known               = inds >= 0
+
+    return inds[known], np.searchsorted(tags._tag_subset_ids, tag_ids[known]), len(summary_ids)
+
+def build():
+    report("Exporting the Last.fm subset taggings...")
+    tags = LastFMTagsDB()
+
+    inds, cols, n = summary_taggings(tags)
+    R = sparse.csr_matrix((np.ones(len(inds), dtype=np.int8), (inds, cols)), shape=(n, len(tags._tag_subset_ids)))
+    R.sum_duplicates()
+
+    # Readers may have the old files memory-mapped, so each is replaced by a
+    # rename rather than rewritten in place. tag_ids goes last, as it marks
+    # the other two valid.
+    for key, arr in (
+        ('indptr',  R.indptr.astype(np.int64)),
+        ('indices', R.indices.astype(np.int16)),
+        ('tag_ids', tags._tag_subset_ids),
+    ):
+        with atomic_write(GET_PATH(key)) as tmp_path, open(tmp_path, 'wb') as f:
+            np.save(f, arr)
+
+
+
+class TagMatrix(object):
+    __metaclass__ = Singleton
+
+    def __init__(self):
+        tag_ids = LastFMTagsDB()._tag_subset_ids
+
+        if not os.path.exists(GET_PATH('tag_ids')) or not np.array_equal(np.load(GET_PATH('tag_ids')), tag_ids):
+            build()
+
+        self.indptr     = np.load(GET_PATH('indptr'), mmap_mode='r')
+        self.indices    = np.load(GET_PATH('indices'), mmap_mode='r')
+        self.shape      = (len(self.indptr) - 1, len(tag_ids))
+
+    def get_tag_data(self, inds):
+        # Tag vectors (one row per summary index) and number of subset tags
+        # of each track, as LastFMTagsDB.get_tag_data gives for one track.
+        inds    = np.asarray(inds)
+        starts  = self.indptr[inds]
+        counts  = self.indptr[inds + 1] - starts
+
+        # Positions of every gathered row's entries in indices.
+        pos     = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        rows    = np.repeat(np.arange(len(inds)), counts)
+
+        tag_vectors = np.zeros((len(inds), self.shape[1]))
+        tag_vectors[rows, self.indices[pos]] = 1.0
+
+        return tag_vectors, counts
+
+    def to_csc(self):
+        # The whole matrix in memory, by tag.
+        return sparse.csr_matrix(
+            (np.ones(len(self.indices), dtype=np.int8), np.asarray(self.indices), np.asarray(self.indptr)),
+            shape=self.shape
+        ).tocsc()
@@ -7,10 +7,14 @@ ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 
 PATHS = {
     'msd_summary_h5':       os.path.join(ROOT_PATH, 'msd/resources/msd_summary_file.h5'),
+    'msd_summary_columns':  os.path.join(ROOT_PATH, 'msd/resources/summary_columns/'),
     'msd_echonest_db':      os.path.join(ROOT_PATH, 'msd/resources/train_triplets.db'),
+    'msd_echonest_triplets': os.path.join(ROOT_PATH, 'msd/resources/train_triplets.txt'),
     'msd_echonest_latent':  os.path.join(ROOT_PATH, 'msd/resources/latent/'),
     'msd_lastfm_db':        os.path.join(ROOT_PATH, 'msd/resources/lastfm_tags.db'),
     'tag_subset':           os.path.join(ROOT_PATH, 'msd/resources/tag_subset.pickle'),
+    'tag_index':            os.path.join(ROOT_PATH, 'msd/resources/tag_index.npz'),
+    'tag_matrix':           os.path.join(ROOT_PATH, 'msd/resources/tag_matrix/'),
     'msd_dataset_split':    os.path.join(ROOT_PATH, 'msd/resources/split.pickle'),
     'convnet_dir':          os.path.join(ROOT_PATH, 'convnet/resources/'),
 }
@@ -1,3 +1,53 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+
+# The process umask, read once at import: os.umask can only be read by
+# setting it, which would race with threads creating files.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+
+@contextmanager
+def atomic_write(path):
+    # Yields a temporary path to write the new version of path to. Once the
+    # block completes the file is synced to disk and renamed over path, so a
+    # crash mid-write leaves the previous version intact; if the block
+    # raises, the temporary file is removed and path is left alone. Every
+    # call gets its own temporary file beside path, so concurrent writers of
+    # the same path don't clobber each other's output.
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + '.',
+        suffix='.tmp'
+    )
+    os.close(fd)
+
+    try:
+        # mkstemp creates the file readable by its owner only; give it the
+        # permissions a plain open() would have.
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+
+        yield tmp_path
+
+        fd = os.open(tmp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+
+
 class Singleton(type):
     def __init__(cls, name, bases, dict):
         super(Singleton, cls).__init__(name, bases, dict)
@@ -7,3 +57,55 @@ class Singleton(type):
         if cls.instance is None:
             cls.instance = super(Singleton, cls).__call__(*args, **kwargs)
         return cls.instance
+
+class LRUCache(object):
+    # Size-bounded, least recently used cache that is safe to share between
+    # threads. The hit, miss and eviction counters are there to size it by.
+    def __init__(self, maxsize):
+        self.maxsize    = maxsize
+        self._data      = OrderedDict()
+        self._lock      = threading.Lock()
+
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+
+    def get(self, key, compute):
+        # The cached value for key, or else compute() and cache its result.
+        # compute runs outside the lock, so slow lookups don't hold up other
+        # threads; two threads missing the same key may both compute it.
+        with self._lock:
+            if key in self._data:
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return value
+
+            self.misses += 1
+
+        value = compute()
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size':         len(self._data),
+                'hits':         self.hits,
+                'misses':       self.misses,
+                'evictions':    self.evictions,
+                'hit_rate':     self.hits / float(lookups) if lookups else 0.0,
+            }
@@ -1,6 +1,8 @@
+from multiprocessing import cpu_count
+
 from krotos.msd.latent.features import LatentFeatures
 
 
 
 lf = LatentFeatures()
-lf.minimize(rounds=15)
+lf.minimize(rounds=15, workers=cpu_count(), tolerance=1e-3)
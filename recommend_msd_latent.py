@@ -0,0 +1,8 @@
+from multiprocessing import cpu_count
+
+from krotos.msd.latent.features import LatentFeatures
+
+
+
+lf = LatentFeatures()
+lf.recommend_all(n=500, workers=cpu_count())
@@ -0,0 +1,5 @@
+from krotos.msd.latent import subset
+
+
+
+subset.build(n_songs=10000, n_users=20000, min_user_songs=5, seed=0)
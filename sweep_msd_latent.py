@@ -0,0 +1,8 @@
+from krotos.msd.latent.sweep import grid, sweep
+
+
+
+sweep(
+    grid(param_lambda=[0.1, 0.5, 2.0], param_alpha=[1.0, 2.0, 4.0]),
+    rounds=10
+)